@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+"""
+Usage:
+  CMD (-T | --test) [-v | --verbose]
+"""
+
+import docopt
+import numpy
+import sys
+from geom3d import Vector, VectorArray, WIGGLE_ROOM
+
+# Most triangles kept in one leaf
+LEAF_SIZE = 4
+
+# Direction BVH.contains casts its ray in, chosen not to line up with the
+# edges of a part drawn on a grid
+PROBE = Vector(0.5710, 0.5773, 0.5839)
+
+
+class BVH(object):
+    """
+    A bounding volume hierarchy over the triangles of a mesh, for queries
+    in any direction. The tree is stored in flat arrays, one row per node:
+    lo and hi bound the node, and count is the number of triangles in a
+    leaf, or 0 for a node with children. A leaf's triangles are
+    triangles[first:first + count]; the children of any other node are
+    nodes first and first + 1. Nodes are split at the median of their
+    triangles' centers along the longest axis, so the tree is about log2(N
+    / LEAF_SIZE) deep, and a query only visits the nodes it touches,
+    level by level, testing all of a level's nodes together.
+
+    >>> from mesh import Mesh
+    >>> box = Mesh([[[0, 0, 0], [0, 1, 1], [0, 1, 0]],
+    ...             [[0, 0, 0], [0, 0, 1], [0, 1, 1]],
+    ...             [[2, 0, 0], [2, 1, 0], [2, 1, 1]],
+    ...             [[2, 0, 0], [2, 1, 1], [2, 0, 1]],
+    ...             [[0, 0, 0], [2, 0, 0], [2, 0, 1]],
+    ...             [[0, 0, 0], [2, 0, 1], [0, 0, 1]],
+    ...             [[0, 1, 0], [2, 1, 1], [2, 1, 0]],
+    ...             [[0, 1, 0], [0, 1, 1], [2, 1, 1]],
+    ...             [[0, 0, 0], [2, 1, 0], [2, 0, 0]],
+    ...             [[0, 0, 0], [0, 1, 0], [2, 1, 0]],
+    ...             [[0, 0, 1], [2, 0, 1], [2, 1, 1]],
+    ...             [[0, 0, 1], [2, 1, 1], [0, 1, 1]]])
+    >>> bvh = BVH(box.vertices, box.normals, leaf_size=2)
+    >>> len(bvh), bvh.count.sum()
+    (15, 12)
+    >>> idx, t = bvh.ray(Vector(-1, 0.25, 0.5), Vector(1, 0, 0))
+    >>> idx.tolist(), t.tolist()
+    ([1, 3], [1.0, 3.0])
+    >>> bvh.ray(Vector(-1, 0.25, 0.5), Vector(-1, 0, 0))[0].tolist()
+    []
+    >>> bvh.segment(Vector(1.5, 0.5, 0.5), Vector(1.5, 0.5, 3))[0].tolist()
+    [10]
+    >>> bvh.contains(Vector(1, 0.5, 0.5)), bvh.contains(Vector(1, 0.5, 2))
+    (True, False)
+    >>> from geom3d import BBox
+    >>> bvh.box(BBox(Vector(1.5, -1, 0.2), Vector(3, 0.5, 0.8))).tolist()
+    [2, 3, 4, 5]
+    """
+
+    def __init__(self, vertices, normals, leaf_size=LEAF_SIZE):
+        self.vertices = vertices
+        self.normals = normals
+        tlo, thi = vertices.min(axis=1), vertices.max(axis=1)
+        centers = (tlo + thi) / 2
+        parts = [numpy.arange(len(vertices))] if len(vertices) else []
+        lo, hi, first, count, triangles = [], [], [], [], []
+        used = 0
+        # Nodes are laid out breadth first, parts[i] holding the triangles
+        # of node i until it is reached; children are appended as the
+        # loop goes
+        for i, idx in enumerate(parts):
+            parts[i] = None
+            lo.append(tlo[idx].min(axis=0))
+            hi.append(thi[idx].max(axis=0))
+            if len(idx) <= leaf_size:
+                first.append(used)
+                count.append(len(idx))
+                triangles.append(idx)
+                used += len(idx)
+                continue
+            c = centers[idx]
+            axis = numpy.argmax(c.max(axis=0) - c.min(axis=0))
+            half = len(idx) // 2
+            order = numpy.argpartition(c[:, axis], half)
+            first.append(len(parts))
+            count.append(0)
+            parts.extend([idx[order[:half]], idx[order[half:]]])
+        self.lo = numpy.array(lo, dtype=numpy.float64).reshape((-1, 3))
+        self.hi = numpy.array(hi, dtype=numpy.float64).reshape((-1, 3))
+        self.first = numpy.array(first, dtype=numpy.intp)
+        self.count = numpy.array(count, dtype=numpy.intp)
+        self.triangles = numpy.concatenate(
+            triangles or [numpy.zeros(0, dtype=numpy.intp)])
+
+    def __len__(self):
+        return len(self.count)
+
+    def candidates(self, hit):
+        """
+        Indices, in ascending order, of the triangles in the leaves whose
+        boxes pass hit(lo, hi), a test of many boxes at once returning a
+        boolean array. Only the children of nodes that pass are tested.
+        """
+        nodes = numpy.arange(min(len(self), 1))
+        found = [numpy.zeros(0, dtype=numpy.intp)]
+        while len(nodes):
+            nodes = nodes[hit(self.lo[nodes], self.hi[nodes])]
+            leaf = self.count[nodes] > 0
+            first, count = self.first[nodes[leaf]], self.count[nodes[leaf]]
+            off = numpy.arange(count.sum()) - numpy.repeat(
+                numpy.cumsum(count) - count, count)
+            found.append(self.triangles[numpy.repeat(first, count) + off])
+            inner = self.first[nodes[~leaf]]
+            nodes = numpy.concatenate((inner, inner + 1))
+        return numpy.sort(numpy.concatenate(found))
+
+    def box(self, bbox):
+        """
+        Indices of the triangles whose bounding boxes overlap bbox, a
+        geom3d.BBox.
+        """
+        W = WIGGLE_ROOM
+        blo = numpy.array([bbox._min.x, bbox._min.y, bbox._min.z])
+        bhi = numpy.array([bbox._max.x, bbox._max.y, bbox._max.z])
+
+        def hit(lo, hi):
+            return ((lo - W < bhi) & (blo < hi + W)).all(axis=1)
+
+        idx = self.candidates(hit)
+        v = self.vertices[idx]
+        return idx[hit(v.min(axis=1), v.max(axis=1))]
+
+    def ray(self, origin, direction, tmin=0.0, tmax=numpy.inf):
+        """
+        The triangles crossed by the points origin + t * direction for
+        tmin <= t <= tmax, and t for each, sorted by t. Crossings within
+        WIGGLE_ROOM of an edge or an end count.
+        """
+        W = WIGGLE_ROOM
+        o = numpy.array([origin.x, origin.y, origin.z], dtype=numpy.float64)
+        d = numpy.array([direction.x, direction.y, direction.z],
+                        dtype=numpy.float64)
+        still = d == 0
+
+        def hit(lo, hi):
+            # Slab test: where the line enters and leaves each box
+            lo, hi = lo - W, hi + W
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                t1, t2 = (lo - o) / d, (hi - o) / d
+            near, far = numpy.minimum(t1, t2), numpy.maximum(t1, t2)
+            # Along an axis the line does not move in, it is either
+            # always between the two faces or never
+            between = (lo[:, still] <= o[still]) & (o[still] <= hi[:, still])
+            near[:, still] = numpy.where(between, -numpy.inf, numpy.inf)
+            far[:, still] = numpy.inf
+            enter, leave = near.max(axis=1), far.min(axis=1)
+            return ((enter <= leave) & (tmin - W <= leave) &
+                    (enter <= tmax + W))
+
+        idx = self.candidates(hit)
+        t, ok = ray_triangles(self.vertices[idx], origin, direction)
+        idx, t = idx[ok], t[ok]
+        ok = (tmin - W <= t) & (t <= tmax + W)
+        idx, t = idx[ok], t[ok]
+        order = numpy.argsort(t, kind='mergesort')
+        return idx[order], t[order]
+
+    def segment(self, p, q):
+        """
+        The triangles crossed by the segment from p to q, and how far
+        along it, from 0 at p to 1 at q, sorted. An empty result means q
+        can be seen from p, see ray.
+        """
+        return self.ray(p, q.diff(p), 0.0, 1.0)
+
+    def contains(self, point):
+        """
+        Whether point is inside the solid, going by the normal of the
+        first triangle a ray from point to outside crosses: it leaves the
+        solid there if the normal points the same way as the ray.
+        """
+        idx, t = self.ray(point, PROBE)
+        if len(idx) == 0:
+            return False
+        n = self.normals[idx[0]]
+        return n[0] * PROBE.x + n[1] * PROBE.y + n[2] * PROBE.z > 0.0
+
+
+def ray_triangles(vertices, origin, direction):
+    """
+    Moller-Trumbore test of the line origin + t * direction against each of
+    the (N, 3, 3) triangles in vertices. Returns t for each triangle and a
+    boolean array of the ones the line crosses, counting crossings within
+    WIGGLE_ROOM of an edge. A line in the plane of a triangle never
+    crosses it.
+
+    >>> t, ok = ray_triangles(numpy.array([[[1, 0, 0], [0, 1, 0], [0, 0, 1]],
+    ...                                    [[1, 0, 0], [1, 1, 0], [1, 0, 1]]],
+    ...                                   dtype=float),
+    ...                       Vector(-1, 0.5, 0.5), Vector(2, 0, 0))
+    >>> t.tolist(), ok.tolist()
+    ([0.5, 1.0], [True, True])
+    >>> ray_triangles(numpy.array([[[1, 0, 0], [0, 1, 0], [0, 0, 1]]],
+    ...                           dtype=float),
+    ...               Vector(0, 0.6, 0.6), Vector(1, 0, 0))[1].tolist()
+    [False]
+    """
+    W = WIGGLE_ROOM
+    v0 = VectorArray(vertices[:, 0])
+    e1 = VectorArray(vertices[:, 1]).diff(v0)
+    e2 = VectorArray(vertices[:, 2]).diff(v0)
+    p = e2.cross(direction).scale(-1.0)
+    det = e1.dot(p)
+    s = v0.diff(origin).scale(-1.0)
+    q = s.cross(e1)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        u = s.dot(p) / det
+        v = q.dot(direction) / det
+        t = e2.dot(q) / det
+        ok = (det != 0.0) & (u >= -W) & (v >= -W) & (u + v <= 1.0 + W)
+    return t, ok
+
+
+def main():
+    args = docopt.docopt(__doc__.replace('CMD', sys.argv[0]))
+
+    if args['-T'] or args['--test']:
+        import doctest
+        verbose = args['-v'] or args['--verbose']
+        failure_count, _ = doctest.testmod(verbose=verbose,
+                                           optionflags=doctest.ELLIPSIS)
+        sys.exit(failure_count)
+
+
+if __name__ == '__main__':
+    main()
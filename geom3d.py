@@ -6,6 +6,7 @@ Usage:
 """
 
 import docopt
+import numpy
 import sys
 
 # Floating point madness
@@ -30,6 +31,7 @@ def sign(x):
 
 
 class Vector(object):
+    __slots__ = ('x', 'y', 'z')
 
     def __init__(self, x, y=None, z=None):
         """
@@ -133,7 +135,117 @@ class Vector(object):
         return Vector(self.x - v.x, self.y - v.y, self.z - v.z)
 
 
-class BBox:
+class VectorArray(object):
+    """
+    N vectors held as the rows of an (N, 3) float64 array, with the same
+    operations as Vector applied to all of them at once. The arithmetic is
+    spelled out the way Vector does it, so each row rounds exactly as the
+    Vector would. The other operand of a binary operation can be a
+    VectorArray of the same length or a single Vector.
+
+    >>> a = VectorArray([(1, 2, 3), (0, 0, 2)])
+    >>> a
+    VectorArray([<1.0,2.0,3.0>, <0.0,0.0,2.0>])
+    >>> a.dot(Vector(4, 5, 6)).tolist()
+    [32.0, 12.0]
+    >>> a.cross(Vector(4, 5, 6))[0]
+    <-3.0,6.0,-3.0>
+    >>> a.add(a).diff(Vector(1, 1, 1))
+    VectorArray([<1.0,3.0,5.0>, <-1.0,-1.0,3.0>])
+    >>> a.scale([2, 0.5])
+    VectorArray([<2.0,4.0,6.0>, <0.0,0.0,1.0>])
+    >>> a.unit_length()[1]
+    <0.0,0.0,1.0>
+    >>> abs(a)[1]
+    2.0
+    >>> VectorArray.from_vectors([Vector(1, 2, 3)]).vectors()
+    [<1.0,2.0,3.0>]
+    """
+    __slots__ = ('xyz',)
+
+    def __init__(self, xyz):
+        xyz = numpy.asarray(xyz, dtype=numpy.float64)
+        self.xyz = xyz.reshape((-1, 3))
+
+    @classmethod
+    def from_vectors(cls, vectors):
+        return cls([(v.x, v.y, v.z) for v in vectors])
+
+    def vectors(self):
+        return [Vector(row) for row in self.xyz.tolist()]
+
+    @property
+    def x(self):
+        return self.xyz[:, 0]
+
+    @property
+    def y(self):
+        return self.xyz[:, 1]
+
+    @property
+    def z(self):
+        return self.xyz[:, 2]
+
+    def __len__(self):
+        return len(self.xyz)
+
+    def __getitem__(self, i):
+        """
+        Row i as a Vector, or a VectorArray of the rows selected by a
+        slice, index array or mask.
+        """
+        if isinstance(i, (int, long, numpy.integer)):
+            return Vector(self.xyz[i].tolist())
+        return VectorArray(self.xyz[i])
+
+    def __iter__(self):
+        return iter(self.vectors())
+
+    def __repr__(self):
+        return 'VectorArray([{0}])'.format(', '.join(map(repr, self)))
+
+    def dot(self, v):
+        vx, vy, vz = v.x, v.y, v.z
+        return self.x * vx + self.y * vy + self.z * vz
+
+    def __abs__(self):
+        return self.dot(self) ** .5
+
+    def scale(self, k):
+        k = numpy.asarray(k, dtype=numpy.float64)
+        if k.ndim:
+            k = k[:, numpy.newaxis]
+        return VectorArray(k * self.xyz)
+
+    def unit_length(self):
+        return self.scale(1.0 / abs(self))
+
+    def cross(self, v):
+        ux, uy, uz = self.x, self.y, self.z
+        vx, vy, vz = v.x, v.y, v.z
+        return VectorArray(numpy.column_stack((uy * vz - uz * vy,
+                                               uz * vx - ux * vz,
+                                               ux * vy - uy * vx)))
+
+    def add(self, v):
+        vx, vy, vz = v.x, v.y, v.z
+        return VectorArray(numpy.column_stack((self.x + vx, self.y + vy,
+                                               self.z + vz)))
+
+    def diff(self, v):
+        vx, vy, vz = v.x, v.y, v.z
+        return VectorArray(numpy.column_stack((self.x - vx, self.y - vy,
+                                               self.z - vz)))
+
+
+class BBox(object):
+    """
+    An axis-aligned box. The corners are _min and _max, and the bounds
+    the contains_ tests compare against, widened by WIGGLE_ROOM, are
+    worked out whenever a corner is set.
+    """
+    __slots__ = ('_lo', '_hi', '_x1', '_x2', '_y1', '_y2', '_z1', '_z2')
+
     def __init__(self, v1=None, v2=None):
         """
         >>> bbox = BBox(Vector(0, 0, 0), Vector(1, 1, 1))
@@ -141,36 +253,56 @@ class BBox:
         <0,0,0>
         >>> bbox._max
         <1,1,1>
+        >>> BBox().contains_x(0)
+        False
         """
         if v1 is not None:
             assert v2 is not None
             assert v1.x <= v2.x
             assert v1.y <= v2.y
             assert v1.z <= v2.z
-            self._min, self._max = v1, v2
-            def contains_x(x, x1=v1.x-WIGGLE_ROOM, x2=v2.x+WIGGLE_ROOM):
-                return x1 < x < x2
-            def contains_y(y, y1=v1.y-WIGGLE_ROOM, y2=v2.y+WIGGLE_ROOM):
-                return y1 < y < y2
-            def contains_z(z, z1=v1.z-WIGGLE_ROOM, z2=v2.z+WIGGLE_ROOM):
-                return z1 < z < z2
-            def contains_yz(y, z, y1=v1.y-WIGGLE_ROOM, y2=v2.y+WIGGLE_ROOM,
-                            z1=v1.z-WIGGLE_ROOM, z2=v2.z+WIGGLE_ROOM):
-                return y1 < y < y2 and z1 < z < z2
+        self._lo, self._hi = v1, v2
+        self._bounds()
+
+    def _bounds(self):
+        lo, hi = self._lo, self._hi
+        if lo is None or hi is None:
+            self._x1 = self._y1 = self._z1 = float('inf')
+            self._x2 = self._y2 = self._z2 = float('-inf')
         else:
-            self._min = self._max = None
-            def contains_x(x):
-                return False
-            def contains_y(y):
-                return False
-            def contains_z(z):
-                return False
-            def contains_yz(y, z):
-                return False
-        self.contains_x = contains_x
-        self.contains_y = contains_y
-        self.contains_z = contains_z
-        self.contains_yz = contains_yz
+            self._x1, self._x2 = lo.x - WIGGLE_ROOM, hi.x + WIGGLE_ROOM
+            self._y1, self._y2 = lo.y - WIGGLE_ROOM, hi.y + WIGGLE_ROOM
+            self._z1, self._z2 = lo.z - WIGGLE_ROOM, hi.z + WIGGLE_ROOM
+
+    @property
+    def _min(self):
+        return self._lo
+
+    @_min.setter
+    def _min(self, v):
+        self._lo = v
+        self._bounds()
+
+    @property
+    def _max(self):
+        return self._hi
+
+    @_max.setter
+    def _max(self, v):
+        self._hi = v
+        self._bounds()
+
+    def contains_x(self, x):
+        return self._x1 < x < self._x2
+
+    def contains_y(self, y):
+        return self._y1 < y < self._y2
+
+    def contains_z(self, z):
+        return self._z1 < z < self._z2
+
+    def contains_yz(self, y, z):
+        return self._y1 < y < self._y2 and self._z1 < z < self._z2
 
     def __contains__(self, vector):
         """
@@ -180,9 +312,9 @@ class BBox:
         >>> Vector(0.5, 0.5, 1.1) in bbox
         False
         """
-        return self.contains_x(vector.x) and \
-            self.contains_y(vector.y) and \
-            self.contains_z(vector.z)
+        return self._x1 < vector.x < self._x2 and \
+            self._y1 < vector.y < self._y2 and \
+            self._z1 < vector.z < self._z2
 
     def __repr__(self):
         return '<BBox {0} {1}>'.format(self._min, self._max)
@@ -279,7 +411,7 @@ class BBox:
         return self._iterator(self._min.z, self._max.z, zsteps)
 
 
-class Triangle:
+class Triangle(object):
     """
     >>> t = Triangle(
     ...     Vector(-20, -15, 0.0),
@@ -313,6 +445,9 @@ class Triangle:
     >>> Vector(-20.0001, -12, 5.0) in t
     False
     """
+    __slots__ = ('vertices', 'normal', 'k',
+                 '_minx', '_miny', '_minz', '_maxx', '_maxy', '_maxz')
+
     def __init__(self, vertex1, vertex2, vertex3, normal=None):
         if normal is None or normal == Vector(0, 0, 0):
             # Replace normal with right-hand-rule-generated unit vector
@@ -322,39 +457,36 @@ class Triangle:
         self.vertices = (vertex1, vertex2, vertex3)
         self.normal = normal
 
-        minx = min(vertex1.x, vertex2.x, vertex3.x)
-        miny = min(vertex1.y, vertex2.y, vertex3.y)
-        minz = min(vertex1.z, vertex2.z, vertex3.z)
-        maxx = max(vertex1.x, vertex2.x, vertex3.x)
-        maxy = max(vertex1.y, vertex2.y, vertex3.y)
-        maxz = max(vertex1.z, vertex2.z, vertex3.z)
-
-        self._bbox = bbox = \
-            BBox(Vector(minx, miny, minz), Vector(maxx, maxy, maxz))
+        self._minx = min(vertex1.x, vertex2.x, vertex3.x)
+        self._miny = min(vertex1.y, vertex2.y, vertex3.y)
+        self._minz = min(vertex1.z, vertex2.z, vertex3.z)
+        self._maxx = max(vertex1.x, vertex2.x, vertex3.x)
+        self._maxy = max(vertex1.y, vertex2.y, vertex3.y)
+        self._maxz = max(vertex1.z, vertex2.z, vertex3.z)
 
         # this number is the same for any point in the triangle
-        self.k = k = normal.dot(vertex1)
-
-        def interior(p,
-                     k=k,
-                     sign=sign,
-                     vertex1=vertex1,
-                     vertex2=vertex2,
-                     vertex3=vertex3,
-                     normal=normal,
-                     diff1=vertex2.diff(vertex1),
-                     diff2=vertex3.diff(vertex2),
-                     diff3=vertex1.diff(vertex3)):
-            return (abs(normal.dot(p) - k) < WIGGLE_ROOM) and [
-                sign(normal.dot(diff1.cross(p.diff(vertex1)))),
-                sign(normal.dot(diff2.cross(p.diff(vertex2)))),
-                sign(normal.dot(diff3.cross(p.diff(vertex3))))
-            ] in ([True, True, True], [False, False, False])
-        self.__contains__ = interior
-
-        def bbox_contains_yz(y, z, f=bbox.contains_yz):
-            return f(y, z)
-        self.bbox_contains_yz = bbox_contains_yz
+        self.k = normal.dot(vertex1)
+
+    @property
+    def _bbox(self):
+        return BBox(Vector(self._minx, self._miny, self._minz),
+                    Vector(self._maxx, self._maxy, self._maxz))
+
+    def __contains__(self, p):
+        normal = self.normal
+        if not abs(normal.dot(p) - self.k) < WIGGLE_ROOM:
+            return False
+        vertex1, vertex2, vertex3 = self.vertices
+        return [
+            sign(normal.dot(vertex2.diff(vertex1).cross(p.diff(vertex1)))),
+            sign(normal.dot(vertex3.diff(vertex2).cross(p.diff(vertex2)))),
+            sign(normal.dot(vertex1.diff(vertex3).cross(p.diff(vertex3))))
+        ] in ([True, True, True], [False, False, False])
+
+    def bbox_contains_yz(self, y, z):
+        W = WIGGLE_ROOM
+        return (self._miny - W < y < self._maxy + W and
+                self._minz - W < z < self._maxz + W)
 
     def __repr__(self):
         vecs = (self.normal,) + self.vertices
@@ -405,9 +537,13 @@ class Triangle:
             return None
 
         # find intersection
-        point = Vector((self.k - normal.y * y - normal.z * z) / nx, y, z)
-        if point not in self._bbox:
+        x = (self.k - normal.y * y - normal.z * z) / nx
+        W = WIGGLE_ROOM
+        if not (self._minx - W < x < self._maxx + W and
+                self._miny - W < y < self._maxy + W and
+                self._minz - W < z < self._maxz + W):
             return None
+        point = Vector(x, y, z)
 
         if point in self:
             return (point, normal)
@@ -415,6 +551,53 @@ class Triangle:
             return None
 
 
+def translation(dx, dy, dz):
+    """
+    The 4x4 matrix that moves points by (dx, dy, dz), see Mesh.transform.
+
+    >>> translation(1, 2, 3)[:3, 3].tolist()
+    [1.0, 2.0, 3.0]
+    """
+    matrix = numpy.identity(4)
+    matrix[:3, 3] = dx, dy, dz
+    return matrix
+
+
+def scaling(sx, sy=None, sz=None):
+    """
+    The 4x4 matrix that scales by sx, sy and sz along the axes, or by sx
+    along all three.
+
+    >>> numpy.diagonal(scaling(2)).tolist()
+    [2.0, 2.0, 2.0, 1.0]
+    """
+    if sy is None:
+        sy = sz = sx
+    return numpy.diag([sx, sy, sz, 1.0])
+
+
+def rotation(axis, degrees):
+    """
+    The 4x4 matrix that turns points about the x, y or z axis by degrees,
+    counterclockwise looking down the axis. Quarter turns are exact.
+
+    >>> rotation('z', 90).astype(int).tolist()
+    [[0, -1, 0, 0], [1, 0, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]]
+    >>> numpy.allclose(numpy.dot(rotation('x', 30), rotation('x', -30)),
+    ...                numpy.identity(4))
+    True
+    """
+    if degrees % 90 == 0:
+        c, s = [(1, 0), (0, 1), (-1, 0), (0, -1)][int(degrees // 90) % 4]
+    else:
+        c, s = numpy.cos(numpy.radians(degrees)), \
+            numpy.sin(numpy.radians(degrees))
+    i, j = {'x': (1, 2), 'y': (2, 0), 'z': (0, 1)}[axis]
+    matrix = numpy.identity(4)
+    matrix[i, i], matrix[i, j], matrix[j, i], matrix[j, j] = c, -s, s, c
+    return matrix
+
+
 def main():
     args = docopt.docopt(__doc__.replace('CMD', sys.argv[0]))
 
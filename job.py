@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+"""
+Usage:
+  CMD -f <filename> -o <job> --z-start=<z> --z-step=<dz> --count=<n>
+      [-m | --mmap] [--cache=<dir>] [--cache-size=<MB>] [options]
+  CMD --info <job>
+  CMD (-T | --test) [-v | --verbose]
+
+Slice an STL into a job file ahead of time: every layer encoded as a PNG,
+with its exposure and the platform move after it. print3d.py --job plays
+a job back without slicing anything.
+
+Options:
+  --exposure=<ms>    Exposure of each layer [default: 1000].
+  --steps=<steps>    Stepper steps to lower the platform after each layer
+                     [default: 720].
+  --width=<pixels>   Frame width [default: 1024].
+  --height=<pixels>  Frame height [default: 768].
+  --red              Draw the part in red rather than white.
+  --scale=<ppu>      Pixels per STL unit, centered on the part. By default
+                     the part is fitted to the frame.
+  --rotate=<x,y,z>   Turn the part first, see stl.py.
+  --fit              Place the part on the build area, see stl.py.
+  -j <processes>     Render layers in this many processes, 0 for one per
+                     core [default: 1].
+  --cache=<dir>      Reuse layers rendered before, see stl.py.
+  --cache-size=<MB>  Size limit of the cache [default: 1024].
+"""
+
+import docopt
+import mmap
+import numpy
+import os
+import string
+import struct
+import sys
+
+# A job file is JOB_HEADER, the encoded layers back to back, then the
+# index, one JOB_INDEX record per layer. The header gives the number of
+# layers, the frame size, the SHA-1 of the mesh (all zeros if there was
+# none) and where the index starts.
+JOB_HEADER = struct.Struct('<4sIIHH20sQ')
+JOB_MAGIC = 'PJOB'
+JOB_VERSION = 1
+JOB_INDEX = numpy.dtype([('offset', '<u8'), ('length', '<u4'),
+                         ('exposure', '<u4'),      # milliseconds
+                         ('z', '<f8'),
+                         ('steps', '<i4')])        # platform move after
+
+
+def write_job(filename, layers, width, height, digest=None):
+    """
+    Write a job file from layers, an iterable of (z, png, exposure,
+    steps), streaming them to disk. A layer the same as the one before
+    it is stored once, with both index records pointing at it. digest is
+    the hex SHA-1 of the mesh, see mesh.Mesh.digest. The file is renamed
+    into place when complete.
+
+    >>> import tempfile
+    >>> filename = tempfile.mktemp()
+    >>> write_job(filename, [(0.1, 'png0', 1000, 720),
+    ...                      (0.2, 'png1', 1500, 720)], 4, 2, 'ab' * 20)
+    >>> job = Job(filename)
+    >>> len(job), job.width, job.height, job.digest == 'ab' * 20
+    (2, 4, 2, True)
+    >>> job.layer(1), job.exposure(1), job.z(1), job.steps(1)
+    ('png1', 1500, 0.2, 720)
+    >>> job.close()
+    >>> write_job(filename, [(0.1, 'png0', 1000, 720),
+    ...                      (0.2, 'png0', 1000, 720)], 4, 2)
+    >>> job = Job(filename)
+    >>> job.index['offset'][0] == job.index['offset'][1]
+    True
+    >>> job.layer(1)
+    'png0'
+    >>> job.close()
+    >>> os.remove(filename)
+    """
+    tmp = '{0}.{1}.tmp'.format(filename, os.getpid())
+    index = []
+    previous = None
+    with open(tmp, 'wb') as outf:
+        outf.write('\0' * JOB_HEADER.size)
+        offset = JOB_HEADER.size
+        for z, png, exposure, steps in layers:
+            if png != previous:
+                outf.write(png)
+                previous, start = png, offset
+                offset += len(png)
+            index.append((start, len(png), exposure, z, steps))
+        outf.write(numpy.array(index, dtype=JOB_INDEX).tostring())
+        outf.seek(0)
+        outf.write(JOB_HEADER.pack(JOB_MAGIC, JOB_VERSION, len(index),
+                                   width, height,
+                                   (digest or '0' * 40).decode('hex'),
+                                   offset))
+    os.rename(tmp, filename)
+
+
+class Job(object):
+    """
+    A job file mapped into memory. Only the index is read when it is
+    opened; each layer is copied out of the mapping when it is asked for.
+
+    >>> import tempfile
+    >>> filename = tempfile.mktemp()
+    >>> open(filename, 'wb').write('PNG!' * 20)
+    >>> Job(filename)
+    Traceback (most recent call last):
+    ...
+    ValueError: not a job file
+    >>> write_job(filename, [(0.1, 'png0', 1000, 720)], 4, 2)
+    >>> data = open(filename, 'rb').read()
+    >>> open(filename, 'wb').write(data[:-1])
+    >>> Job(filename)
+    Traceback (most recent call last):
+    ...
+    ValueError: truncated job file
+    >>> os.remove(filename)
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as inf:
+            self.map = mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < JOB_HEADER.size:
+            raise ValueError('not a job file')
+        magic, version, count, self.width, self.height, digest, offset = \
+            JOB_HEADER.unpack_from(self.map)
+        if magic != JOB_MAGIC:
+            raise ValueError('not a job file')
+        if version != JOB_VERSION:
+            raise ValueError('job file version {0}'.format(version))
+        if offset + count * JOB_INDEX.itemsize > len(self.map):
+            raise ValueError('truncated job file')
+        self.digest = digest.encode('hex')
+        if self.digest == '0' * 40:
+            self.digest = None
+        self.index = numpy.frombuffer(self.map, dtype=JOB_INDEX, count=count,
+                                      offset=offset)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __repr__(self):
+        return '<Job "{0}" {1} layers {2}x{3}>'.format(
+            self.filename, len(self), self.width, self.height)
+
+    def layer(self, i):
+        """
+        The encoded layer i, as a string a web server can send whole.
+        """
+        offset = int(self.index[i]['offset'])
+        return self.map[offset:offset + int(self.index[i]['length'])]
+
+    def exposure(self, i):
+        return int(self.index[i]['exposure'])
+
+    def z(self, i):
+        return float(self.index[i]['z'])
+
+    def steps(self, i):
+        return int(self.index[i]['steps'])
+
+    def close(self):
+        self.index = None
+        self.map.close()
+
+
+def compile_stl(filename, out, z_start, z_step, count, exposure, steps, red,
+                width=1024, height=768, scale=None, processes=1, mmap=False,
+                cache=None, rotate=None, fit=False):
+    """
+    Slice count layers of an STL from z_start up, z_step apart, into the
+    job file out.
+    """
+    from stl import place
+    stl, bbox = place(filename, width, height, scale, mmap, rotate, fit)
+    layers = stl.make_layers(z_start, z_step, count, width, height, bbox, red,
+                             processes=processes, png=True, cache=cache)
+    write_job(out, ((z, png, exposure, steps) for z, png in layers),
+              width, height, stl.digest())
+
+
+def main():
+    args = docopt.docopt(__doc__.replace('CMD', sys.argv[0]))
+
+    if args['-T'] or args['--test']:
+        import doctest
+        verbose = args['-v'] or args['--verbose']
+        failure_count, _ = doctest.testmod(verbose=verbose,
+                                           optionflags=doctest.ELLIPSIS)
+        sys.exit(failure_count)
+
+    if args['--info']:
+        job = Job(args['<job>'])
+        print job
+        print 'mesh', job.digest
+        for i in range(len(job)):
+            print i, job.z(i), len(job.layer(i)), job.exposure(i), \
+                job.steps(i)
+        return
+
+    from stl import parse_angles
+    scale = args['--scale'] and string.atof(args['--scale'])
+    if args['--fit'] and not scale:
+        sys.exit('--fit needs --scale')
+    cache = None
+    if args['--cache']:
+        from slicecache import SliceCache
+        cache = SliceCache(args['--cache'],
+                           string.atoi(args['--cache-size']) << 20)
+    compile_stl(args['<filename>'], args['<job>'],
+                string.atof(args['--z-start']), string.atof(args['--z-step']),
+                string.atoi(args['--count']),
+                string.atoi(args['--exposure']), string.atoi(args['--steps']),
+                args['--red'], string.atoi(args['--width']),
+                string.atoi(args['--height']), scale,
+                processes=string.atoi(args['-j']) or None,
+                mmap=args['-m'] or args['--mmap'], cache=cache,
+                rotate=args['--rotate'] and parse_angles(args['--rotate']),
+                fit=args['--fit'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,902 @@
+#!/usr/bin/env python
+
+"""
+Usage:
+  CMD (-T | --test) [-v | --verbose]
+"""
+
+import docopt
+import hashlib
+import numpy
+import sys
+from geom3d import Triangle, BBox, Vector, VectorArray, WIGGLE_ROOM
+from bvh import BVH
+from raster import ray_spans
+
+# Number of triangle records LazyMesh decodes at a time
+CHUNK = 1 << 16
+
+# Most (ray, triangle) pairs Mesh.intersect_rays tests at a time
+RAY_BATCH = 1 << 20
+
+
+class GridIndex(object):
+    """
+    A uniform grid over (y, z) listing, for each cell, the triangles whose
+    bounding boxes overlap it. The lists are kept in one flat array of
+    triangle indices, in triangle order, with an offset array marking where
+    each cell starts.
+
+    >>> lo = numpy.array([[0, 0, 0], [0, 2, 2], [0, 0, 0]], dtype=float)
+    >>> hi = numpy.array([[1, 1, 1], [1, 3, 3], [1, 3, 3]], dtype=float)
+    >>> g = GridIndex(lo, hi)
+    >>> g.query(0.5, 0.5).tolist()
+    [0, 2]
+    >>> g.query(2.5, 2.5).tolist()
+    [1, 2]
+    >>> g.query(2.5, 0.5).tolist()
+    [2]
+    >>> g.query(5, 5).tolist()
+    []
+    """
+
+    def __init__(self, lo, hi):
+        W = WIGGLE_ROOM
+        n = len(lo)
+        ylo, yhi = lo[:, 1] - W, hi[:, 1] + W
+        zlo, zhi = lo[:, 2] - W, hi[:, 2] + W
+        if n == 0:
+            ylo = yhi = zlo = zhi = numpy.zeros(1)
+        self.y0, self.z0 = ylo.min(), zlo.min()
+        yspan = max(yhi.max() - self.y0, W)
+        zspan = max(zhi.max() - self.z0, W)
+        # Aim for cells about twice the size of a typical triangle, but no
+        # more than a few cells per triangle overall.
+        dy = max(2 * numpy.median(yhi - ylo), yspan / 1024)
+        dz = max(2 * numpy.median(zhi - zlo), zspan / 1024)
+        ny = int(numpy.ceil(yspan / dy))
+        nz = int(numpy.ceil(zspan / dz))
+        shrink = (ny * nz / (4.0 * n + 16)) ** .5
+        if shrink > 1:
+            ny = max(1, int(ny / shrink))
+            nz = max(1, int(nz / shrink))
+        self.ny, self.nz = ny, nz
+        self.dy, self.dz = yspan / ny, zspan / nz
+
+        iy0, iy1 = self._cells(ylo, yhi, self.y0, self.dy, ny)
+        iz0, iz1 = self._cells(zlo, zhi, self.z0, self.dz, nz)
+        wy = iy1 - iy0 + 1
+        counts = wy * (iz1 - iz0 + 1)
+        if n == 0:
+            counts = counts[:0]
+        tri = numpy.repeat(numpy.arange(len(counts)), counts)
+        starts = numpy.cumsum(counts) - counts
+        off = numpy.arange(len(tri)) - numpy.repeat(starts, counts)
+        cell = ((iz0[tri] + off // wy[tri]) * ny +
+                iy0[tri] + off % wy[tri])
+        order = numpy.argsort(cell, kind='mergesort')
+        self.triangles = tri[order]
+        self.offsets = numpy.searchsorted(cell[order],
+                                          numpy.arange(ny * nz + 1))
+
+    @staticmethod
+    def _cells(lo, hi, origin, size, n):
+        first = numpy.floor((lo - origin) / size).astype(numpy.intp)
+        last = numpy.floor((hi - origin) / size).astype(numpy.intp)
+        return first.clip(0, n - 1), last.clip(0, n - 1)
+
+    def query(self, y, z):
+        """
+        Indices, in ascending order, of the triangles whose bounding boxes
+        may contain the line parallel to the x axis at (y, z).
+        """
+        iy = int(numpy.floor((y - self.y0) / self.dy))
+        iz = int(numpy.floor((z - self.z0) / self.dz))
+        if not (0 <= iy < self.ny and 0 <= iz < self.nz):
+            return self.triangles[:0]
+        cell = iz * self.ny + iy
+        return self.triangles[self.offsets[cell]:self.offsets[cell + 1]]
+
+
+def sweep(zlo, zhi, zs):
+    """
+    Walk increasing heights zs, yielding (z, idx) where idx lists, in
+    ascending order, the triangles with zlo - WIGGLE_ROOM < z < zhi +
+    WIGGLE_ROOM. Triangles are sorted by zlo once, join the active set
+    when z passes their bottom and are retired once z passes their top, so
+    each height only costs as much as the triangles that cross it.
+
+    >>> zlo = numpy.array([0.0, 1.0, 2.0, 0.0])
+    >>> zhi = numpy.array([1.5, 3.0, 2.5, 0.2])
+    >>> [(z, idx.tolist()) for z, idx in sweep(zlo, zhi, [0.1, 1.2, 2.2, 4])]
+    [(0.1, [0, 3]), (1.2, [0, 1]), (2.2, [1, 2]), (4, [])]
+    >>> list(sweep(zlo, zhi, [2, 1]))
+    Traceback (most recent call last):
+    ...
+    ValueError: heights must increase
+    """
+    W = WIGGLE_ROOM
+    bottoms = zlo - W
+    tops = zhi + W
+    order = numpy.argsort(bottoms, kind='mergesort')
+    bottoms = bottoms[order]
+    active = numpy.zeros(0, dtype=numpy.intp)
+    added = 0
+    last = None
+    for z in zs:
+        if last is not None and z < last:
+            raise ValueError('heights must increase')
+        last = z
+        n = numpy.searchsorted(bottoms, z, side='left')
+        active = numpy.concatenate((active, order[added:n]))
+        added = n
+        active = active[z < tops[active]]
+        yield z, numpy.sort(active)
+
+
+def plane_segments(mesh, z):
+    """
+    Cut every triangle of mesh with the plane at height z, returning an
+    (n, 2, 2) array of line segments in (x, y). Each segment runs so that
+    the solid is on its left, which makes outer boundaries counterclockwise
+    and holes clockwise. A vertex exactly at z counts as above the plane,
+    and both triangles on an edge get bit-identical crossing points, so
+    the segments can be chained by exact comparison.
+
+    >>> m = Mesh([[[0, 0, 0], [1, 0, 0], [0, 0, 1]]], [[0, -1, 0]])
+    >>> plane_segments(m, 0.5).tolist()
+    [[[0.0, 0.0], [0.5, 0.0]]]
+    >>> plane_segments(m, 2).shape
+    (0, 2, 2)
+    """
+    v = mesh.vertices
+    above = v[:, :, 2] >= z
+    count = above.sum(axis=1)
+    crossing = (count == 1) | (count == 2)
+    v, above = v[crossing], above[crossing]
+    normals = mesh.normals[crossing]
+    rows = numpy.arange(len(v))
+    points, crossed = [], []
+    for a, b in ((0, 1), (1, 2), (2, 0)):
+        # Always interpolate from the lower end so shared edges agree.
+        lo = numpy.where(above[:, a], b, a)
+        hi = numpy.where(above[:, a], a, b)
+        p, q = v[rows, lo], v[rows, hi]
+        # Edges that do not cross come out as NaN and are never picked.
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            t = (z - p[:, 2]) / (q[:, 2] - p[:, 2])
+            points.append(p[:, :2] +
+                          t[:, numpy.newaxis] * (q[:, :2] - p[:, :2]))
+        crossed.append(above[:, a] != above[:, b])
+    points = numpy.concatenate([xy[:, numpy.newaxis] for xy in points],
+                               axis=1)
+    crossed = numpy.array(crossed).T
+    edges = numpy.argsort(~crossed, axis=1, kind='mergesort')
+    segments = numpy.concatenate(
+        [points[rows, edges[:, 0]][:, numpy.newaxis],
+         points[rows, edges[:, 1]][:, numpy.newaxis]], axis=1)
+    d = segments[:, 1] - segments[:, 0]
+    flip = d[:, 1] * normals[:, 0] - d[:, 0] * normals[:, 1] < 0
+    segments[flip] = segments[flip, ::-1]
+    return segments[(d != 0).any(axis=1)]
+
+
+def chain_segments(segments):
+    """
+    Join segments end to start into polygons, using a hash of their end
+    points. Closed polygons end with a repeat of their first point; if the
+    mesh has holes some chains will not close and are returned as found.
+
+    >>> square = [[(0, 0), (1, 0)], [(1, 1), (0, 1)],
+    ...           [(1, 0), (1, 1)], [(0, 1), (0, 0)], [(5, 5), (6, 6)]]
+    >>> chain_segments(square)
+    [[(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)], [(5, 5), (6, 6)]]
+    """
+    if isinstance(segments, numpy.ndarray):
+        segments = segments.tolist()
+    segments = [(tuple(p), tuple(q)) for p, q in segments]
+    starts = {}
+    for i, (p, q) in enumerate(segments):
+        starts.setdefault(p, []).append(i)
+    used = [False] * len(segments)
+    polygons = []
+    for i, (p, q) in enumerate(segments):
+        if used[i]:
+            continue
+        used[i] = True
+        polygon = [p, q]
+        while q != p:
+            following = [j for j in starts.get(q, ()) if not used[j]]
+            if not following:
+                break
+            used[following[0]] = True
+            q = segments[following[0]][1]
+            polygon.append(q)
+        polygons.append(polygon)
+    return polygons
+
+
+def polygon_area(polygon):
+    """
+    Signed area of a closed polygon, positive when counterclockwise.
+
+    >>> polygon_area([(0, 0), (2, 0), (2, 1), (0, 1), (0, 0)])
+    2.0
+    """
+    a = 0.0
+    for (x1, y1), (x2, y2) in zip(polygon, polygon[1:]):
+        a += x1 * y2 - x2 * y1
+    return a / 2
+
+
+def digest_update(sha, mesh):
+    """
+    Feed a Mesh to a hashlib object, one row of nine vertex coordinates
+    and three normal components per triangle.
+    """
+    rows = numpy.hstack((mesh.vertices.reshape(-1, 9), mesh.normals))
+    sha.update(rows.tostring())
+
+
+def bbox_of(lo, hi):
+    if len(lo) == 0:
+        return BBox()
+    return BBox(Vector(lo.min(axis=0).tolist()),
+                Vector(hi.max(axis=0).tolist()))
+
+
+class Mesh(object):
+    """
+    A triangle mesh stored as a structure of arrays rather than a list of
+    Triangle objects. Row i of each array describes triangle i.
+
+        vertices   (N, 3, 3) float64, the three corners of each triangle
+        normals    (N, 3) float64
+        lo, hi     (N, 3) float64, per-triangle bounding boxes
+        k          (N,) float64, normal dot first vertex
+
+    >>> m = Mesh([[[0, 0, 0], [1, 0, 0], [1, 1, 0]]])
+    >>> len(m)
+    1
+    >>> m.normals.tolist()
+    [[0.0, 0.0, 1.0]]
+    >>> m.lo.tolist(), m.hi.tolist()
+    ([[0.0, 0.0, 0.0]], [[1.0, 1.0, 0.0]])
+    >>> m.bbox()
+    <BBox <0.0,0.0,0.0> <1.0,1.0,0.0>>
+    >>> Mesh(numpy.zeros((0, 3, 3))).bbox()
+    <BBox None None>
+    """
+
+    def __init__(self, vertices, normals=None):
+        vertices = numpy.ascontiguousarray(vertices, dtype=numpy.float64)
+        vertices = vertices.reshape((-1, 3, 3))
+        n = len(vertices)
+        if normals is None:
+            normals = numpy.zeros((n, 3))
+        else:
+            normals = numpy.array(normals, dtype=numpy.float64)
+            normals = normals.reshape((n, 3))
+        # Like Triangle, replace missing normals with the right-hand-rule
+        # generated unit vector.
+        missing = abs(VectorArray(normals)) < WIGGLE_ROOM
+        if missing.any():
+            v = vertices[missing]
+            v1, v2, v3 = VectorArray(v[:, 0]), VectorArray(v[:, 1]), \
+                VectorArray(v[:, 2])
+            normals[missing] = v2.diff(v1).cross(v3.diff(v2)).unit_length().xyz
+        self.vertices = vertices
+        self.normals = normals
+        self.lo = vertices.min(axis=1)
+        self.hi = vertices.max(axis=1)
+        self.k = VectorArray(normals).dot(VectorArray(vertices[:, 0]))
+        self._bbox = None
+        self._grid = None
+        self._bvh = None
+        self._digest = None
+
+    @classmethod
+    def from_triangles(cls, triangles):
+        """
+        >>> t = Triangle(Vector(1, 2, 3), Vector(4, 5, 6), Vector(7, 8, 10))
+        >>> m = Mesh.from_triangles([t])
+        >>> m.triangle(0) == t
+        True
+        >>> u = Triangle(Vector(0.1, 0.2, 0.3), Vector(1.7, 0.5, 0.6),
+        ...              Vector(0.7, 0.8, 1.9))
+        >>> m = Mesh([[(v.x, v.y, v.z) for v in u.vertices]])
+        >>> m.normals[0].tolist() == [u.normal.x, u.normal.y, u.normal.z]
+        True
+        >>> m.k[0] == u.k
+        True
+        """
+        vertices = [[(v.x, v.y, v.z) for v in t.vertices] for t in triangles]
+        normals = [(t.normal.x, t.normal.y, t.normal.z) for t in triangles]
+        return cls(numpy.array(vertices).reshape(-1, 3, 3),
+                   numpy.array(normals).reshape(-1, 3))
+
+    def __len__(self):
+        return len(self.vertices)
+
+    def triangle(self, i):
+        """
+        Build a geom3d.Triangle for row i, for code that still wants one.
+        """
+        v = self.vertices[i].tolist()
+        return Triangle(Vector(v[0]), Vector(v[1]), Vector(v[2]),
+                        Vector(self.normals[i].tolist()))
+
+    def bbox(self):
+        if self._bbox is None:
+            self._bbox = bbox_of(self.lo, self.hi)
+        return self._bbox
+
+    def digest(self):
+        """
+        Hex SHA-1 of the triangles, which identifies the geometry whatever
+        file format it was read from.
+
+        >>> m = Mesh([[[0, 0, 0], [1, 0, 0], [1, 1, 0]]])
+        >>> m.digest() == Mesh(m.vertices, m.normals).digest()
+        True
+        >>> m.digest() == Mesh([[[0, 0, 0], [1, 0, 0], [1, 2, 0]]]).digest()
+        False
+        """
+        if self._digest is None:
+            sha = hashlib.sha1()
+            digest_update(sha, self)
+            self._digest = sha.hexdigest()
+        return self._digest
+
+    def take(self, idx):
+        """
+        A new Mesh holding the triangles selected by idx (an index array or
+        boolean mask), in their original order.
+
+        >>> m = Mesh([[[0, 0, 0], [1, 0, 0], [1, 1, 0]],
+        ...           [[0, 0, 1], [1, 0, 1], [1, 1, 1]]])
+        >>> m.take([1]).bbox()
+        <BBox <0.0,0.0,1.0> <1.0,1.0,1.0>>
+        """
+        m = Mesh.__new__(Mesh)
+        for name in ('vertices', 'normals', 'lo', 'hi', 'k'):
+            setattr(m, name, getattr(self, name)[idx])
+        m._bbox = m._grid = m._bvh = m._digest = None
+        return m
+
+    def transform(self, matrix):
+        """
+        A new Mesh with every vertex moved by the 4x4 affine matrix, in
+        one pass over the arrays (see geom3d.rotation and friends). The
+        normals are turned by the inverse transpose. A matrix that mirrors
+        the part also reverses the order of each triangle's vertices, so
+        they still follow the right-hand rule about the normal. For a
+        matrix that only scales and moves, the bounding boxes are mapped
+        across rather than measured again.
+
+        >>> from geom3d import rotation, scaling, translation
+        >>> m = Mesh([[[0, 0, 0], [1, 0, 0], [1, 1, 0]]])
+        >>> m.bbox()
+        <BBox <0.0,0.0,0.0> <1.0,1.0,0.0>>
+        >>> t = m.transform(numpy.dot(translation(1, 2, 3), scaling(2)))
+        >>> t.vertices[0].tolist()
+        [[1.0, 2.0, 3.0], [3.0, 2.0, 3.0], [3.0, 4.0, 3.0]]
+        >>> t.bbox()
+        <BBox <1.0,2.0,3.0> <3.0,4.0,3.0>>
+        >>> t = m.transform(rotation('x', 90))
+        >>> t.normals.tolist(), t.bbox()
+        ([[0.0, -1.0, 0.0]], <BBox <0.0,0.0,0.0> <1.0,0.0,1.0>>)
+        >>> t = m.transform(scaling(1, 1, -1))
+        >>> t.normals.tolist(), t.triangle(0).normal
+        ([[0.0, 0.0, -1.0]], <0.0,0.0,-1.0>)
+        >>> Mesh(t.vertices).normals.tolist()
+        [[0.0, 0.0, -1.0]]
+        """
+        matrix = numpy.asarray(matrix, dtype=numpy.float64)
+        linear, offset = matrix[:3, :3], matrix[:3, 3]
+        v = self.vertices
+        vertices = (v[..., 0, numpy.newaxis] * linear[:, 0] +
+                    v[..., 1, numpy.newaxis] * linear[:, 1] +
+                    v[..., 2, numpy.newaxis] * linear[:, 2] + offset)
+        n = self.normals
+        inverse = numpy.linalg.inv(linear)
+        normals = (n[:, 0, numpy.newaxis] * inverse[0] +
+                   n[:, 1, numpy.newaxis] * inverse[1] +
+                   n[:, 2, numpy.newaxis] * inverse[2])
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            normals = VectorArray(normals).unit_length().xyz
+        if numpy.linalg.det(linear) < 0:
+            vertices = vertices[:, [0, 2, 1]]
+        m = Mesh.__new__(Mesh)
+        m.vertices = vertices
+        m.normals = normals
+        m._bbox = m._grid = m._bvh = m._digest = None
+        diagonal = numpy.diagonal(linear)
+        if (linear == numpy.diag(diagonal)).all():
+            # The same arithmetic as the vertices, and it preserves order,
+            # so these are the corners the vertices would give
+            a = self.lo * diagonal + offset
+            b = self.hi * diagonal + offset
+            m.lo, m.hi = numpy.minimum(a, b), numpy.maximum(a, b)
+        else:
+            m.lo, m.hi = vertices.min(axis=1), vertices.max(axis=1)
+        m.k = VectorArray(normals).dot(VectorArray(vertices[:, 0]))
+        return m
+
+    def grid(self):
+        """
+        The GridIndex over this mesh, built on first use.
+        """
+        if self._grid is None:
+            self._grid = GridIndex(self.lo, self.hi)
+        return self._grid
+
+    def bvh(self):
+        """
+        The bvh.BVH over this mesh, for queries in any direction, built on
+        first use.
+
+        >>> m = Mesh([[[0, 0, 0], [1, 0, 0], [0, 1, 0]]])
+        >>> m.bvh().ray(Vector(0.25, 0.25, 1), Vector(0, 0, -1))[1].tolist()
+        [1.0]
+        >>> m.take([0]).digest() == m.digest()
+        True
+        """
+        if self._bvh is None:
+            self._bvh = BVH(self.vertices, self.normals)
+        return self._bvh
+
+    def layer(self, z):
+        """
+        The triangles whose z range includes z, which are the only ones
+        that can be crossed by any line in the plane at that height.
+
+        >>> m = Mesh([[[0, 0, 0], [1, 0, 0], [1, 1, 1]],
+        ...           [[0, 0, 1], [1, 0, 1], [1, 1, 2]]])
+        >>> len(m.layer(0.5)), len(m.layer(1.0)), len(m.layer(3))
+        (1, 2, 0)
+        """
+        W = WIGGLE_ROOM
+        return self.take(numpy.flatnonzero((self.lo[:, 2] - W < z) &
+                                           (z < self.hi[:, 2] + W)))
+
+    def layers(self, zs):
+        """
+        Yield a Layer for each of the increasing heights zs, see sweep.
+
+        >>> m = Mesh([[[0, 0, 0], [1, 0, 0], [1, 1, 1]],
+        ...           [[0, 0, 1], [1, 0, 1], [1, 1, 2]]])
+        >>> [len(layer) for layer in m.layers([0.5, 1.0, 1.5, 3])]
+        [1, 2, 1, 0]
+        """
+        for z, idx in sweep(self.lo[:, 2], self.hi[:, 2], zs):
+            yield Layer(z, self.take(idx))
+
+    def intersect(self, y, z):
+        """
+        Vectorized form of Triangle.intersect over the whole mesh. Returns
+        the indices of the triangles that the line parallel to the x axis
+        at (y, z) passes through, and the x coordinates of the crossings.
+        Only the triangles listed in the grid cell for (y, z) are tested.
+
+        >>> m = Mesh([[[1.0, 1.0, 0.0], [1.0, 0.0, 0.0], [1.0, 0.0, 1.0]],
+        ...           [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]])
+        >>> i, x = m.intersect(0.4, 0.4)
+        >>> i.tolist(), [round(v, 9) for v in x]
+        ([0, 1], [1.0, 0.2])
+        >>> i, x = m.intersect(0.6, 0.6)
+        >>> i.tolist(), x.tolist()
+        ([], [])
+        """
+        idx = self.grid().query(y, z)
+        ok, x = self._crossings(idx, y, z)
+        return idx[ok], x
+
+    def _crossings(self, idx, y, z):
+        """
+        Test the lines at (y, z) against triangles idx, where y and z are
+        scalars or arrays as long as idx. Returns the indices into idx of
+        the pairs that cross, and the x coordinates of the crossings.
+        """
+        lo, hi = self.lo, self.hi
+        W = WIGGLE_ROOM
+        # Same tests, in the same order and with the same rounding, as
+        # BBox.contains_yz, Triangle.intersect and the interior test.
+        keep = numpy.flatnonzero((lo[idx, 1] - W < y) & (y < hi[idx, 1] + W) &
+                                 (lo[idx, 2] - W < z) & (z < hi[idx, 2] + W) &
+                                 (self.normals[idx, 0] != 0.0))
+        idx = idx[keep]
+        if numpy.ndim(y):
+            y, z = y[keep], z[keep]
+        n = self.normals[idx]
+        nx, ny, nz = n[:, 0], n[:, 1], n[:, 2]
+        k = self.k[idx]
+        x = (k - ny * y - nz * z) / nx
+        ok = (lo[idx, 0] - W < x) & (x < hi[idx, 0] + W)
+        ok &= abs(nx * x + ny * y + nz * z - k) < W
+
+        v = self.vertices[idx]
+        signs = []
+        for a, b in ((0, 1), (1, 2), (2, 0)):
+            d = v[:, b] - v[:, a]
+            qx, qy, qz = x - v[:, a, 0], y - v[:, a, 1], z - v[:, a, 2]
+            cx = d[:, 1] * qz - d[:, 2] * qy
+            cy = d[:, 2] * qx - d[:, 0] * qz
+            cz = d[:, 0] * qy - d[:, 1] * qx
+            signs.append(nx * cx + ny * cy + nz * cz > 0.0)
+        ok &= (signs[0] == signs[1]) & (signs[1] == signs[2])
+        return keep[ok], x[ok]
+
+    def intersect_rays(self, ys, zs):
+        """
+        Mesh.intersect for many lines parallel to the x axis at once, the
+        line i being at (ys[i], zs[i]); either may be a scalar. Returns
+        arrays of the line, the triangle and the x coordinate of every
+        crossing, ordered by line and then triangle. Each triangle is only
+        paired with the lines inside its y range, and the pairs are tested
+        together, RAY_BATCH at a time.
+
+        >>> m = Mesh([[[1.0, 1.0, 0.0], [1.0, 0.0, 0.0], [1.0, 0.0, 1.0]],
+        ...           [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]])
+        >>> rays, i, x = m.intersect_rays([0.6, 0.4, 0.2], [0.6, 0.4, 0.2])
+        >>> rays.tolist(), i.tolist(), [round(v, 9) for v in x]
+        ([1, 1, 2, 2], [0, 1, 0, 1], [1.0, 0.2, 1.0, 0.6])
+        """
+        ys, zs = numpy.broadcast_arrays(numpy.asarray(ys, dtype=numpy.float64),
+                                        numpy.asarray(zs, dtype=numpy.float64))
+        ys, zs = ys.ravel(), zs.ravel()
+        W = WIGGLE_ROOM
+        order = numpy.argsort(ys, kind='mergesort')
+        sorted_ys = ys[order]
+        first = numpy.searchsorted(sorted_ys, self.lo[:, 1] - W, side='right')
+        last = numpy.searchsorted(sorted_ys, self.hi[:, 1] + W, side='left')
+        counts = (last - first).clip(0)
+        ends = numpy.cumsum(counts)
+        found = [(numpy.zeros(0, dtype=numpy.intp),) * 2 +
+                 (numpy.zeros(0),)]
+        start = 0
+        while start < len(counts):
+            stop = max(numpy.searchsorted(ends, ends[start] - counts[start] +
+                                          RAY_BATCH, side='right'), start + 1)
+            c = counts[start:stop]
+            tri = numpy.repeat(numpy.arange(start, stop), c)
+            off = numpy.arange(len(tri)) - numpy.repeat(numpy.cumsum(c) - c, c)
+            rays = order[first[tri] + off]
+            ok, x = self._crossings(tri, ys[rays], zs[rays])
+            found.append((rays[ok], tri[ok], x))
+            start = stop
+        rays, idx, xs = [numpy.concatenate(a) for a in zip(*found)]
+        order = numpy.lexsort((idx, rays))
+        return rays[order], idx[order], xs[order]
+
+    def crossings(self, ys, z):
+        """
+        The crossings of the lines at (ys[i], z) sorted by line and then
+        x, as arrays of the line, the x coordinate and the triangle. Where
+        a line crosses several triangles at the same x, every one of those
+        crossings is given the triangle listed last, just as point_list
+        does.
+        """
+        rays, idx, xs = self.intersect_rays(ys, z)
+        order = numpy.lexsort((idx, xs, rays))
+        rays, idx, xs = rays[order], idx[order], xs[order]
+        if len(rays):
+            group = numpy.cumsum(numpy.r_[0, (rays[1:] != rays[:-1]) |
+                                          (xs[1:] != xs[:-1])])
+            last = numpy.r_[numpy.flatnonzero(numpy.diff(group)),
+                            len(group) - 1]
+            idx, xs = idx[last[group]], xs[last[group]]
+        return rays, xs, idx
+
+    def point_lists(self, ys, z):
+        """
+        point_list for each of the lines at (ys[i], z), found all at once.
+
+        >>> m = Mesh([[[0, 0, 0], [0, 0, 1], [0, 1, 0]],
+        ...           [[1, 0, 0], [0, 1, 0], [0, 0, 1]]])
+        >>> m.point_lists([0.25, 2, 0.5], 0.25) == \\
+        ...     [m.point_list(y, 0.25) for y in [0.25, 2, 0.5]]
+        True
+        """
+        rays, xs, idx = self.crossings(ys, z)
+        lists = [[] for y in ys]
+        normals = self.normals[idx].tolist()
+        for ray, x, normal in zip(rays.tolist(), xs.tolist(), normals):
+            lists[ray].append((Vector(x, ys[ray], z), Vector(normal)))
+        return lists
+
+    def point_list(self, y, z):
+        """
+        The crossings of the line at (y, z) sorted by x, each given as a
+        (point, normal) pair of Vectors.
+
+        >>> m = Mesh([[[0, 0, 0], [0, 0, 1], [0, 1, 0]],
+        ...           [[1, 0, 0], [0, 1, 0], [0, 0, 1]]])
+        >>> m.point_list(0.25, 0.25)
+        [(<-0.0,0.25,0.25>, <-1.0,0.0,0.0>), (<0.5,0.25,0.25>, <...>)]
+        """
+        idx, xs = self.intersect(y, z)
+        xs = xs.tolist()
+        points = {}
+        for i, x in zip(idx.tolist(), xs):
+            points[x] = (Vector(x, y, z), Vector(self.normals[i].tolist()))
+        xs.sort()
+        return [points[x] for x in xs]
+
+
+class LazyMesh(object):
+    """
+    A mesh whose triangles stay in an array of records, usually a
+    numpy.memmap of a file, and are only decoded when a query needs them.
+    The records need 'vertices' and 'normal' fields. Memory use is bounded
+    by CHUNK records plus the triangles of the current layer.
+
+    >>> records = numpy.zeros(3, dtype=[('normal', '<f4', (3,)),
+    ...                                 ('vertices', '<f4', (3, 3))])
+    >>> records['vertices'] = [[[0, 0, 0], [1, 0, 0], [1, 1, 1]],
+    ...                        [[0, 0, 1], [1, 0, 1], [1, 1, 2]],
+    ...                        [[0, 0, 0], [0, 0, 1], [0, 1, 0]]]
+    >>> m = LazyMesh(records, chunk=2)
+    >>> len(m)
+    3
+    >>> m.bbox()
+    <BBox <0.0,0.0,0.0> <1.0,1.0,2.0>>
+    >>> len(m.layer(1.5))
+    1
+    >>> m.point_list(0.25, 0.25)
+    [(<-0.0,0.25,0.25>, <-1.0,0.0,0.0>)]
+    >>> m.triangle(2).normal
+    <-1.0,0.0,0.0>
+    >>> m.digest() == m.decode(slice(None)).digest()
+    True
+    """
+
+    def __init__(self, records, chunk=CHUNK):
+        self.records = records
+        self.chunk = chunk
+        self._bbox = None
+        self._layer = None
+        self._zranges = None
+        self._digest = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def decode(self, idx):
+        records = self.records[idx]
+        return Mesh(records['vertices'], records['normal'])
+
+    def triangle(self, i):
+        return self.decode(slice(i, i + 1)).triangle(0)
+
+    def chunks(self):
+        """
+        Yield (offset, records) for successive blocks of records.
+        """
+        for i in range(0, len(self), self.chunk):
+            yield i, self.records[i:i + self.chunk]
+
+    def bbox(self):
+        if self._bbox is None:
+            lo, hi = [], []
+            for i, records in self.chunks():
+                v = records['vertices']
+                lo.append(v.min(axis=1).min(axis=0))
+                hi.append(v.max(axis=1).max(axis=0))
+            self._bbox = bbox_of(numpy.array(lo, dtype=numpy.float64),
+                                 numpy.array(hi, dtype=numpy.float64))
+        return self._bbox
+
+    def digest(self):
+        """
+        Same as Mesh.digest, a chunk at a time.
+        """
+        if self._digest is None:
+            sha = hashlib.sha1()
+            for i, records in self.chunks():
+                digest_update(sha, self.decode(slice(i, i + self.chunk)))
+            self._digest = sha.hexdigest()
+        return self._digest
+
+    def layer(self, z):
+        if self._layer is not None and self._layer[0] == z:
+            return self._layer[1]
+        W = WIGGLE_ROOM
+        idx = [numpy.zeros(0, dtype=numpy.intp)]
+        for i, records in self.chunks():
+            zs = records['vertices'][:, :, 2].astype(numpy.float64)
+            idx.append(i + numpy.flatnonzero((zs.min(axis=1) - W < z) &
+                                             (z < zs.max(axis=1) + W)))
+        layer = self.decode(numpy.concatenate(idx))
+        self._layer = (z, layer)
+        return layer
+
+    def point_list(self, y, z):
+        return self.layer(z).point_list(y, z)
+
+    def point_lists(self, ys, z):
+        return self.layer(z).point_lists(ys, z)
+
+    def transform(self, matrix):
+        """
+        Mesh.transform of all the triangles, which are decoded to do it.
+        """
+        return self.decode(slice(None)).transform(matrix)
+
+    def crossings(self, ys, z):
+        return self.layer(z).crossings(ys, z)
+
+    def zranges(self):
+        """
+        Per-triangle bottom and top heights, read in one pass and kept.
+        """
+        if self._zranges is None:
+            zlo, zhi = [], []
+            for i, records in self.chunks():
+                zs = records['vertices'][:, :, 2]
+                zlo.append(zs.min(axis=1))
+                zhi.append(zs.max(axis=1))
+            self._zranges = (numpy.concatenate(zlo).astype(numpy.float64),
+                             numpy.concatenate(zhi).astype(numpy.float64))
+        return self._zranges
+
+    def layers(self, zs):
+        """
+        Like Mesh.layers, decoding only the triangles of each layer.
+        """
+        zlo, zhi = self.zranges()
+        for z, idx in sweep(zlo, zhi, zs):
+            yield Layer(z, self.decode(idx))
+
+
+class Layer(object):
+    """
+    The triangles of a mesh that cross the plane at height z.
+
+    >>> m = Mesh([[[0, 0, 0], [0, 0, 1], [0, 1, 0]],
+    ...           [[1, 0, 0], [0, 1, 0], [0, 0, 1]]])
+    >>> layer = Layer(0.25, m)
+    >>> layer.point_list(0.25)
+    [(<-0.0,0.25,0.25>, <-1.0,0.0,0.0>), (<0.5,0.25,0.25>, <...>)]
+    """
+
+    def __init__(self, z, mesh):
+        self.z = z
+        self.mesh = mesh
+        self._contours = None
+
+    def __len__(self):
+        return len(self.mesh)
+
+    def __repr__(self):
+        return '<Layer z={0} {1} triangles>'.format(self.z, len(self))
+
+    def point_list(self, y):
+        return self.mesh.point_list(y, self.z)
+
+    def point_lists(self, ys):
+        return self.mesh.point_lists(ys, self.z)
+
+    def spans(self, ys):
+        """
+        The spans of solid along the lines at each of ys, as arrays of
+        the line and the x coordinates where each span starts and ends,
+        see raster.ray_spans.
+
+        >>> m = Mesh([[[0, 0, 0], [0, 0, 1], [0, 1, 0]],
+        ...           [[1, 0, 0], [0, 1, 0], [0, 0, 1]]])
+        >>> rays, x1s, x2s = Layer(0.25, m).spans([0.25, 2, 0.5])
+        >>> rays.tolist(), x1s.tolist(), [round(x, 9) for x in x2s]
+        ([0, 2], [-0.0, -0.0], [0.5, 0.25])
+        """
+        rays, xs, idx = self.mesh.crossings(ys, self.z)
+        return ray_spans(rays, xs, self.mesh.normals[idx, 0])
+
+    def contours(self):
+        """
+        The outline of the slice as a list of polygons, each a list of
+        (x, y) points, worked out once per layer. Closed polygons repeat
+        their first point at the end; outer boundaries run
+        counterclockwise and holes clockwise.
+
+        >>> box = Mesh([[[0, 0, 0], [0, 1, 1], [0, 1, 0]],
+        ...             [[0, 0, 0], [0, 0, 1], [0, 1, 1]],
+        ...             [[2, 0, 0], [2, 1, 0], [2, 1, 1]],
+        ...             [[2, 0, 0], [2, 1, 1], [2, 0, 1]],
+        ...             [[0, 0, 0], [2, 0, 0], [2, 0, 1]],
+        ...             [[0, 0, 0], [2, 0, 1], [0, 0, 1]],
+        ...             [[0, 1, 0], [2, 1, 1], [2, 1, 0]],
+        ...             [[0, 1, 0], [0, 1, 1], [2, 1, 1]]])
+        >>> layer = Layer(0.5, box)
+        >>> [len(polygon) for polygon in layer.contours()]
+        [9]
+        >>> layer.area()
+        2.0
+        >>> layer.scan([0.5, 2.0])
+        [[0.0, 2.0], []]
+        """
+        if self._contours is None:
+            segments = plane_segments(self.mesh.layer(self.z), self.z)
+            self._contours = chain_segments(segments)
+        return self._contours
+
+    def area(self):
+        """
+        Net area of the closed contours, holes subtracted.
+        """
+        return sum(polygon_area(p) for p in self.contours()
+                   if len(p) > 2 and p[0] == p[-1])
+
+    def scan(self, ys):
+        """
+        Scan-convert the contours: for each y, the sorted x coordinates
+        where the closed contours cross the line at that y. Edges are
+        half-open in y so vertices are not counted twice.
+        """
+        edges = [(p, q) for polygon in self.contours()
+                 if polygon[0] == polygon[-1]
+                 for p, q in zip(polygon, polygon[1:])]
+        edges = numpy.array(edges, dtype=numpy.float64).reshape(-1, 2, 2)
+        x0, y0 = edges[:, 0, 0], edges[:, 0, 1]
+        x1, y1 = edges[:, 1, 0], edges[:, 1, 1]
+        ylo, yhi = numpy.minimum(y0, y1), numpy.maximum(y0, y1)
+        rows = []
+        for y in ys:
+            i = numpy.flatnonzero((ylo <= y) & (y < yhi))
+            xs = x0[i] + (y - y0[i]) * (x1[i] - x0[i]) / (y1[i] - y0[i])
+            rows.append(sorted(xs.tolist()))
+        return rows
+
+
+class TriangleView(object):
+    """
+    Read-only sequence of geom3d.Triangle objects backed by a Mesh. The
+    Triangles are built on demand and not kept.
+
+    >>> m = Mesh([[[0, 0, 0], [1, 0, 0], [1, 1, 0]],
+    ...           [[0, 0, 1], [1, 0, 1], [1, 1, 1]]])
+    >>> view = TriangleView(m)
+    >>> len(view)
+    2
+    >>> view[-1].vertices
+    (<0.0,0.0,1.0>, <1.0,0.0,1.0>, <1.0,1.0,1.0>)
+    >>> [t.normal for t in view]
+    [<0.0,0.0,1.0>, <0.0,0.0,1.0>]
+    >>> len(view[:1])
+    1
+    """
+
+    def __init__(self, mesh):
+        self.mesh = mesh
+
+    def __len__(self):
+        return len(self.mesh)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.mesh.triangle(j)
+                    for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.mesh.triangle(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.mesh.triangle(i)
+
+
+def main():
+    args = docopt.docopt(__doc__.replace('CMD', sys.argv[0]))
+
+    if args['-T'] or args['--test']:
+        import doctest
+        verbose = args['-v'] or args['--verbose']
+        failure_count, _ = doctest.testmod(verbose=verbose,
+                                           optionflags=doctest.ELLIPSIS)
+        sys.exit(failure_count)
+
+
+if __name__ == '__main__':
+    main()
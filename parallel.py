@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+"""
+Usage:
+  CMD (-T | --test) [-v | --verbose]
+"""
+
+import collections
+import docopt
+import multiprocessing
+import sys
+
+# The function ordered_map is running. It is set before the pool forks, so
+# the workers inherit it, and everything it refers to such as a mesh,
+# instead of having it pickled and sent with every task.
+_work = None
+
+# AsyncResult.get() without a timeout cannot be interrupted on Python 2
+FOREVER = 1 << 30
+
+
+def _call(item):
+    return _work(item)
+
+
+def ordered_map(func, items, processes=None, lookahead=None):
+    """
+    Yield func(item) for each item, in order, computed by a pool of
+    processes forked for the purpose (one per core by default). At most
+    lookahead items, twice the number of processes by default, are
+    handed out ahead of the result being waited for, so a long job runs
+    in bounded memory. func and its data are shared with the workers by
+    fork and never pickled, only the items and results are.
+
+    >>> k = 3
+    >>> list(ordered_map(lambda x: x * k, range(10), processes=3))
+    [0, 3, 6, 9, 12, 15, 18, 21, 24, 27]
+    >>> list(ordered_map(abs, [-1, 2], processes=1))
+    [1, 2]
+    >>> list(ordered_map(int, ['1', 'x'], processes=2))
+    Traceback (most recent call last):
+    ...
+    ValueError: invalid literal for int() with base 10: 'x'
+    """
+    global _work
+    if processes == 1:
+        for item in items:
+            yield func(item)
+        return
+    processes = processes or multiprocessing.cpu_count()
+    lookahead = max(lookahead or 2 * processes, 1)
+    previous, _work = _work, func
+    try:
+        pool = multiprocessing.Pool(processes)
+    finally:
+        _work = previous
+    try:
+        pending = collections.deque()
+        for item in items:
+            pending.append(pool.apply_async(_call, (item,)))
+            if len(pending) >= lookahead:
+                yield pending.popleft().get(FOREVER)
+        while pending:
+            yield pending.popleft().get(FOREVER)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def main():
+    args = docopt.docopt(__doc__.replace('CMD', sys.argv[0]))
+
+    if args['-T'] or args['--test']:
+        import doctest
+        verbose = args['-v'] or args['--verbose']
+        failure_count, _ = doctest.testmod(verbose=verbose,
+                                           optionflags=doctest.ELLIPSIS)
+        sys.exit(failure_count)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,23 @@
 
 """
 Usage:
-  CMD [-d <duration>] [--red | -r] [-s | --server] [-T | --test] [-D | --debug]
+  CMD [-d <duration>] [--red | -r] [-s | --server] [-m | --manual]
+      [-l <lookahead>] [-j <processes>] [--scale=<ppu>] [-T | --test]
+      [-D | --debug]
+  CMD --compile=<job> [-d <duration>] [--red | -r] [-j <processes>]
+      [--scale=<ppu>]
+  CMD --job=<job> [-s | --server] [-l <lookahead>]
+
+Options:
+  -m --manual     Step through layers with the keyboard, n for next and q
+                  to quit, instead of running the print on a timer.
+  -l <lookahead>  How many layers to render ahead of the one on display
+                  [default: 4].
+  -j <processes>  Render layers in this many processes, 0 for one per
+                  core [default: 1].
+  --scale=<ppu>   Pixels per unit the part is drawn at [default: 3].
+  --compile=<job>  Render every layer into a job file instead of printing.
+  --job=<job>      Print a job file made by --compile or job.py.
 """
 
 """
@@ -43,20 +59,31 @@ won't need an "ary" for the entire image.
 
 import os.path
 import cherrypy
-import array
+import cherrypy.lib.cptools
 import docopt
+import numpy
 import os
+import Queue
 import string
 import sys
 import termios
 import threading
+import time
 import tty
+from cherrypy.process.plugins import Monitor
+from job import Job, write_job
+from parallel import ordered_map
+from raster import Frame, atomic_write, encode_spans, RED, WHITE
 
 W, H = 1024, 768
 duration = 1000
 
-WHITE = '\xff\xff\xff'
-RED = '\xff\x00\x00'
+# Stepper steps in the one-layer move CherryPyServer.move makes
+LAYER_STEPS = 720
+
+# How long to wait for the browser to say it has shown a layer before
+# timing the exposure from when it was published
+DISPLAY_TIMEOUT = 5.0
 
 SCALE = 3
 
@@ -65,97 +92,351 @@ class AbstractMethodError(NotImplementedError):
     pass
 
 
-class Image(object):
+class Image(Frame):
+    """
+    A W x H frame drawn with shapes centered on the middle of the image,
+    in units of scale pixels. Every shape becomes a batch of horizontal
+    spans painted in place.
+
+    >>> img = Image()
+    >>> img.rectangles([(0, 0), (10, 10)], 3, 3)
+    >>> int(img.mask().sum())
+    144
+    """
     def __init__(self, scale=SCALE):
-        self.ary = array.array('B')
-        self.ary.fromstring(3 * W * H * '\x00')
+        Frame.__init__(self, W, H)
         self.scale = scale
 
+    def _check(self, x1, x2, y):
+        x1, x2, y = (numpy.asarray(a, dtype=numpy.intp) for a in (x1, x2, y))
+        assert (x1 <= x2).all()
+        drawn = x1 != x2
+        x1, x2, y = x1[drawn], x2[drawn], y[drawn]
+        assert ((0 <= x1) & (x1 < W)).all()
+        assert ((0 <= x2) & (x2 < W)).all()
+        assert ((0 <= y) & (y < H)).all()
+        return x1, x2, y
+
     def run(self, x1, x2, y, color=WHITE):
-        assert x1 <= x2
-        if x1 == x2:
-            return
-        assert 0 <= x1 < W
-        assert 0 <= x2 < W
-        assert 0 <= y < H
-        begin = 3 * (W * y + x1)
-        end = 3 * (W * y + x2)
-        middle = array.array('B')
-        middle.fromstring((x2 - x1) * color)
-        self.ary = self.ary[:begin] + middle + self.ary[end:]
+        self.runs([x1], [x2], [y], color)
+
+    def runs(self, x1, x2, y, color=WHITE):
+        """
+        Draw the spans x1[i] <= x < x2[i] on rows y[i], all in one go.
+        """
+        x1, x2, y = self._check(x1, x2, y)
+        self.spans(y, x1, x2, color)
+
+    def _center(self, xcenter, ycenter):
+        return (int((W / 2) + self.scale * xcenter),
+                int((H / 2) - self.scale * ycenter))   # intentional
 
     def rectangle(self, xcenter, ycenter, xsize, ysize, color=WHITE):
+        self.rectangles([(xcenter, ycenter)], xsize, ysize, color)
+
+    def rectangles(self, centers, xsize, ysize, color=WHITE):
+        """
+        Draw an xsize by ysize rectangle at each (x, y) center.
+        """
         if self.scale is not None:
-            xcenter = int((W / 2) + self.scale * xcenter)
-            ycenter = int((H / 2) - self.scale * ycenter)   # intentional
+            centers = [self._center(x, y) for x, y in centers]
             xsize *= self.scale
             ysize *= self.scale
         xsize = int(xsize)
         ysize = int(ysize)
         xsize2 = xsize / 2
         ysize2 = ysize / 2
-        for i in range(ysize):
-            self.run(xcenter - xsize2,
-                     xcenter + xsize2,
-                     (ycenter - ysize2) + i,
-                     color)
+        for xcenter, ycenter in centers:
+            if ysize <= 0:
+                continue
+            x1, x2 = xcenter - xsize2, xcenter + xsize2
+            y1 = ycenter - ysize2
+            self._check([x1, x1], [x2, x2], [y1, y1 + ysize - 1])
+            self.pixels[y1:y1 + ysize, x1:x2] = self.rgb(color)
 
     def circle(self, xcenter, ycenter, radius, color=WHITE):
         if self.scale is not None:
-            xcenter = int((W / 2) + self.scale * xcenter)
-            ycenter = int((H / 2) - self.scale * ycenter)   # intentional
+            xcenter, ycenter = self._center(xcenter, ycenter)
             radius = self.scale * radius
-        for y in range(int(ycenter - radius - 1), int(ycenter + radius + 1)):
-            d = radius**2 - (y - ycenter)**2
-            if d >= 0:
-                self.run(int(xcenter - d**0.5),
-                         int(xcenter + d**0.5),
-                         y,
-                         color)
+        y = numpy.arange(int(ycenter - radius - 1), int(ycenter + radius + 1))
+        d = radius**2 - (y - ycenter)**2
+        y, d = y[d >= 0], d[d >= 0]
+        self.runs((xcenter - d**0.5).astype(int),
+                  (xcenter + d**0.5).astype(int),
+                  y, color)
 
     def hollow_diamond(self, xcenter, ycenter, size, width,
                        color=WHITE):
         if self.scale is not None:
-            xcenter = int((W / 2) + self.scale * xcenter)
-            ycenter = int((H / 2) - self.scale * ycenter)   # intentional
+            xcenter, ycenter = self._center(xcenter, ycenter)
             size *= self.scale
             width *= self.scale
-        for i in range(int(width)):
-            y = int(ycenter - size) + i
-            self.run(xcenter - i, xcenter + i, y, color)
-        for i in range(int(size - width)):
-            y = int(ycenter + width - size) + i
-            self.run(xcenter - width - i, xcenter - i, y, color)
-            self.run(xcenter + i, xcenter + width + i, y, color)
-        for i in range(int(size - width)):
-            y = ycenter + i
-            self.run(xcenter - size + i, xcenter - size + width + i, y, color)
-            self.run(xcenter + size - width - i, xcenter + size - i, y, color)
-        for i in range(int(width)):
-            y = int(ycenter + size - width) + i
-            self.run(xcenter - width + i, xcenter + width - i, y, color)
+        i = numpy.arange(int(width))
+        j = numpy.arange(int(size - width))
+        x1 = [xcenter - i,
+              xcenter - width - j, xcenter + j,
+              xcenter - size + j, xcenter + size - width - j,
+              xcenter - width + i]
+        x2 = [xcenter + i,
+              xcenter - j, xcenter + width + j,
+              xcenter - size + width + j, xcenter + size - j,
+              xcenter + width - i]
+        y = [int(ycenter - size) + i,
+             int(ycenter + width - size) + j, int(ycenter + width - size) + j,
+             ycenter + j, ycenter + j,
+             int(ycenter + size - width) + i]
+        self.runs(numpy.concatenate(x1), numpy.concatenate(x2),
+                  numpy.concatenate(y), color)
 
     def write(self, z):
-        try:
-            os.remove('foo.rgb')
-        except:
-            pass
-        outf = open('foo.rgb', 'w')
-        outf.write(self.ary.tostring())
-        outf.close()
-        os.system(('convert -size {0}x{1} -alpha off -depth 8' +
-                   ' foo.rgb static/image.png').format(W, H))
-        os.system('echo "{0} {1}" > static/image.info'
-                  .format(z, duration))
+        atomic_write('static/image.png', self.png())
+        atomic_write('static/image.info', '{0} {1}\n'.format(z, duration))
+
+
+class FrameCache(object):
+    """
+    The encoded frames the server hands out, held in memory so requests
+    never touch the disk. Frames are added by index and one of them is
+    current. Each frame gets an ETag made of a counter that goes up on
+    every change plus the index, so browsers can revalidate cheaply; the
+    ETag of /info is made of what it says, so it only changes with it.
+    Only the last few frames are kept, plus the current one. A frame
+    that is the same as the one before it is noted as a repeat of the
+    first frame of the run, so the page can keep that on screen.
+
+    >>> cache = FrameCache(size=2)
+    >>> cache.info()
+    >>> cache.publish(-20, 'png-20', 1000)
+    >>> cache.info()
+    '-20 1000 -20\\n'
+    >>> cache.add(-19, 'png-19', 1000)
+    >>> cache.get()
+    ('png-20', '"1--20"')
+    >>> cache.get(-19)
+    ('png-19', '"3--19"')
+    >>> cache.show(-19)
+    >>> cache.info_etag()
+    '"-19:1000:-19"'
+    >>> cache.add(-18, 'png-18', 1000)
+    >>> cache.info_etag()
+    '"-19:1000:-19"'
+    >>> sorted(cache.frames)
+    [-19, -18]
+    >>> cache.add(-17, 'png-18', 1000)
+    >>> cache.show(-17)
+    >>> cache.info()
+    '-17 1000 -18\\n'
+    >>> cache.same(-17), cache.same(-18)
+    (-18, -18)
+    """
+
+    def __init__(self, size=4):
+        self.size = size
+        self.condition = threading.Condition()
+        # index -> (png, duration, etag, mask, color, same)
+        self.frames = {}
+        self.current = None
+        self.version = 0
+        self.displayed = None     # (index, time) the browser reported
+
+    def add(self, index, png, duration, mask=None, color=None):
+        """
+        Add a frame. Single-colored frames can also be given as a boolean
+        mask of lit pixels and their color, for the span transport.
+        """
+        with self.condition:
+            self.version += 1
+            etag = '"{0}-{1}"'.format(self.version, index)
+            same = index
+            previous = self.frames.get(index - 1)
+            if previous is not None and previous[0] == png:
+                png, mask, color, same = (previous[0], previous[3],
+                                          previous[4], previous[5])
+            self.frames[index] = (png, duration, etag, mask, color, same)
+            for old in sorted(self.frames)[:-self.size]:
+                if old != self.current:
+                    del self.frames[old]
+            self.condition.notify_all()
+
+    def show(self, index):
+        with self.condition:
+            assert index in self.frames, index
+            self.version += 1
+            self.current = index
+            self.condition.notify_all()
+
+    def publish(self, index, png, duration):
+        with self.condition:
+            self.add(index, png, duration)
+            self.show(index)
+
+    def get(self, index=None):
+        """
+        (png, etag) for a frame, the current one by default, or None.
+        """
+        with self.condition:
+            if index is None:
+                index = self.current
+            if index not in self.frames:
+                return None
+            return self.frames[index][0], self.frames[index][2]
+
+    def same(self, index):
+        """
+        The first frame of the run of identical frames that index is in,
+        or None if index is not cached.
+        """
+        with self.condition:
+            if index not in self.frames:
+                return None
+            return self.frames[index][5]
+
+    def info(self):
+        with self.condition:
+            if self.current is None:
+                return None
+            duration, same = (self.frames[self.current][1],
+                              self.frames[self.current][5])
+            return '{0} {1} {2}\n'.format(self.current, duration, same)
+
+    def info_etag(self):
+        with self.condition:
+            if self.current is None:
+                return None
+            duration, same = (self.frames[self.current][1],
+                              self.frames[self.current][5])
+            return '"{0}:{1}:{2}"'.format(self.current, duration, same)
+
+    def wait(self, after=None, timeout=25):
+        """
+        Block until the current frame is something other than after, or
+        timeout seconds pass, then return info(). Waiters sleep without a
+        timeout so a change wakes them at once; tick() wakes them now and
+        then to check their deadlines.
+
+        >>> cache = FrameCache()
+        >>> cache.wait(timeout=0)
+        >>> cache.publish(3, 'png3', 500)
+        >>> cache.wait(2, timeout=0)
+        '3 500 3\\n'
+        >>> t = threading.Timer(0.1, cache.publish, (4, 'png4', 500))
+        >>> t.start()
+        >>> cache.wait(3, timeout=60)
+        '4 500 4\\n'
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while self.current in (None, after) and time.time() < deadline:
+                self.condition.wait()
+            return self.info()
+
+    def wait_for(self, index, timeout=25):
+        """
+        Like get(index), but if that frame has not been added yet and
+        could still come, block for up to timeout seconds until it is.
+        This lets a browser ask for the next layer before it is ready.
+
+        >>> cache = FrameCache()
+        >>> cache.publish(3, 'png3', 500)
+        >>> t = threading.Timer(0.1, cache.add, (4, 'png4', 500))
+        >>> t.start()
+        >>> cache.wait_for(4, timeout=60)
+        ('png4', '"3-4"')
+        >>> cache.wait_for(5, timeout=0)
+        >>> cache.wait_for(2, timeout=60)
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while index not in self.frames and \
+                    (self.current is None or index > self.current) and \
+                    time.time() < deadline:
+                self.condition.wait()
+            return self.get(index)
+
+    def spans(self, index, base=None):
+        """
+        Frame index as encoded spans (see raster.encode_spans), relative to
+        frame base if that is still in the cache, or None if the frame is
+        missing or has more than one color.
+
+        >>> cache = FrameCache()
+        >>> mask = numpy.zeros((2, 4), dtype=bool)
+        >>> cache.add(1, 'png1', 500, mask, RED)
+        >>> cache.add(2, 'png2', 500, ~mask, RED)
+        >>> cache.add(3, 'png3', 500)
+        >>> len(cache.spans(2)), len(cache.spans(2, 1)), cache.spans(3)
+        (36, 36, None)
+        """
+        with self.condition:
+            if index not in self.frames:
+                return None
+            mask, color = self.frames[index][3:5]
+            base_mask = None
+            if base in self.frames:
+                base_mask = self.frames[base][3]
+        if mask is None:
+            return None
+        if base_mask is None:
+            base = None
+        return encode_spans(index, mask, color, base, base_mask)
+
+    def mark_displayed(self, index):
+        """
+        Record that the browser has put a frame on the screen.
+        """
+        with self.condition:
+            self.displayed = (index, time.time())
+            self.condition.notify_all()
+
+    def wait_displayed(self, index, timeout=DISPLAY_TIMEOUT):
+        """
+        Block until the browser reports frame index on screen, returning
+        the time it did, or None after timeout seconds.
+
+        >>> cache = FrameCache()
+        >>> cache.wait_displayed(1, timeout=0)
+        >>> t = threading.Timer(0.1, cache.mark_displayed, (1,))
+        >>> t.start()
+        >>> cache.wait_displayed(1, timeout=60) <= time.time()
+        True
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while (self.displayed is None or self.displayed[0] != index) \
+                    and time.time() < deadline:
+                self.condition.wait()
+            if self.displayed is not None and self.displayed[0] == index:
+                return self.displayed[1]
+            return None
+
+    def tick(self):
+        with self.condition:
+            self.condition.notify_all()
+
+
+def conditional(etag, content_type):
+    """
+    Tag the response and answer 304 Not Modified if the browser already
+    has this version.
+    """
+    headers = cherrypy.response.headers
+    headers['ETag'] = etag
+    headers['Cache-Control'] = 'no-cache'
+    headers['Content-Type'] = content_type
+    cherrypy.lib.cptools.validate_etags()
 
 
 class CherryPyServer(threading.Thread):
 
     server_running = False
+    scale = SCALE       # pixels per unit of the layers drawn
 
     def __init__(self):
         threading.Thread.__init__(self)
         self.daemon = True
+        self.frames = FrameCache()
+        self.last_encoded = None    # (digest, encoded) of the last frame
+        self.stepper = None
 
     def run(self):
         config = {
@@ -188,31 +469,195 @@ class CherryPyServer(threading.Thread):
         from jinja2tool import Jinja2Tool
         cherrypy.tools.template = Jinja2Tool()
 
+        # Wake long-polling requests so they notice their timeouts
+        Monitor(cherrypy.engine, self.frames.tick, frequency=1).subscribe()
+
         cherrypy.quickstart(self, '', config=config)
 
     @cherrypy.expose
-    def index(self):
-        return {}
+    def index(self, transport='png'):
+        """
+        The page the projector shows. With ?transport=spans it draws
+        layers on a canvas from /spans instead of loading PNGs.
+        """
+        if transport not in ('png', 'spans'):
+            transport = 'png'
+        return {'transport': transport}
+
+    @cherrypy.expose
+    def image(self, index=None, timeout=25):
+        """
+        /image is the current frame. /image/<n> is frame n, which may be
+        fetched ahead of time: if it has not been rendered yet the request
+        waits for it. A frame that repeats an earlier one still cached
+        redirects there, which the browser already has.
+        """
+        if index is None:
+            frame = self.frames.get()
+        else:
+            index = int(index)
+            frame = self.frames.wait_for(index, float(timeout))
+            same = self.frames.same(index)
+            if frame is not None and same != index and \
+                    self.frames.get(same) is not None:
+                raise cherrypy.HTTPRedirect('/image/{0}'.format(same))
+        if frame is None:
+            raise cherrypy.NotFound()
+        png, etag = frame
+        conditional(etag, 'image/png')
+        return png
 
     @cherrypy.expose
-    def image(self):
-        return open('static/image.png', 'r').read()
+    def spans(self, index, base=None, timeout=25):
+        """
+        /spans/<n>?base=<m> is layer n as runs of lit pixels, or as the
+        runs that changed since layer m, for the canvas renderer in
+        index.html. Frames with more than one color are only available as
+        PNG.
+        """
+        index = int(index)
+        if self.frames.wait_for(index, float(timeout)) is None:
+            raise cherrypy.NotFound()
+        data = self.frames.spans(index, None if base is None else int(base))
+        if data is None:
+            raise cherrypy.NotFound()
+        headers = cherrypy.response.headers
+        headers['Cache-Control'] = 'no-cache'
+        headers['Content-Type'] = 'application/octet-stream'
+        return data
+
+    @cherrypy.expose
+    def displayed(self, index):
+        """
+        The page reports here when it has actually put a frame on screen.
+        """
+        self.frames.mark_displayed(int(index))
+        return ''
 
     @cherrypy.expose
     def info(self):
-        return open('static/image.info', 'r').read()
+        info = self.frames.info()
+        if info is None:
+            raise cherrypy.NotFound()
+        conditional(self.frames.info_etag(), 'text/plain')
+        return info
 
-    def stop(self):
+    @cherrypy.expose
+    def wait(self, after=None, timeout=25):
+        """
+        Long poll: answers with the same text as /info as soon as the
+        current frame is not the one numbered after, or after timeout
+        seconds if nothing changes.
+        """
+        if after is not None:
+            after = int(after)
+        info = self.frames.wait(after, float(timeout))
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        cherrypy.response.headers['Content-Type'] = 'text/plain'
+        return info or ''
+
+    def encode(self, img):
+        """
+        Everything the server needs for a frame: the PNG, plus the mask
+        of lit pixels and their color if there is only one color. A frame
+        the same as the last one is not encoded again.
+
+        >>> server = CherryPyServer()
+        >>> img = Image()
+        >>> img.rectangle(0, 0, 10, 10, RED)
+        >>> encoded = server.encode(img)
+        >>> img = Image()
+        >>> img.rectangle(0, 0, 10, 10, RED)
+        >>> server.encode(img) is encoded
+        True
+        """
+        digest = img.digest()
+        if self.last_encoded is not None and self.last_encoded[0] == digest:
+            return self.last_encoded[1]
+        color = img.color()
+        mask = img.mask() if color is not None else None
+        encoded = img.png(), mask, color
+        self.last_encoded = (digest, encoded)
+        return encoded
+
+    def stage(self, img, z):
+        self.stage_encoded(z, self.encode(img))
+
+    def stage_encoded(self, z, encoded):
+        """
+        Hand over the frame for layer z ahead of showing it. With the
+        server running it goes straight into the in-memory cache, where
+        the page can already fetch it as /image/<z>.
+        """
+        png, mask, color = encoded
+        if self.server_running:
+            self.frames.add(z, png, self.exposure(z), mask, color)
+        else:
+            self.staged = png
+
+    def show(self, z):
+        """
+        Make the staged layer z the one on display. Without the server it
+        is written to static/ as before.
+        """
         if self.server_running:
-            cherrypy.engine.exit()
+            self.frames.show(z)
+        else:
+            atomic_write('static/image.png', self.staged)
+            atomic_write('static/image.info',
+                         '{0} {1}\n'.format(z, self.exposure(z)))
+
+    def publish(self, img, z):
+        self.stage(img, z)
+        self.show(z)
+
+    def stop(self):
+        """
+        Called by layer() when there are no more layers, or to abandon
+        the print. main() shuts the server down.
+        """
         raise SystemExit
 
+    def render(self, z, color):
+        """
+        Draw layer z: support posts below zero, the part from zero up.
+        """
+        img = Image(self.scale)
+        if z < 0:
+            img.rectangles(self.supports(), 3, 3, color)
+        else:
+            self.layer(z, img, duration, color)
+        return img
+
+    def encoded(self, z, color):
+        return self.encode(self.render(z, color))
+
+    def exposure(self, z):
+        """
+        Milliseconds to expose layer z for.
+        """
+        return duration
+
+    def move(self, z):
+        """
+        Lower the build platform one layer after exposing layer z.
+        """
+        self.stepper_comm().down()
+
+    def stepper_comm(self):
+        """
+        The connection to the stepper controller, opened on the first
+        move and kept for the rest of the print, since opening the serial
+        port resets the Arduino.
+        """
+        if self.stepper is None:
+            from arduino.stepper import StepperComm
+            self.stepper = StepperComm()
+        return self.stepper
+
     def build_supports(self, color):
         for z in range(-20, 0):
-            img = Image()
-            for x, y in self.supports():
-                img.rectangle(x, y, 3, 3, color)
-            img.write(z)
+            self.publish(self.render(z, color), z)
             self.after_layer()
 
     def supports(self):
@@ -253,25 +698,324 @@ class CherryPyServer(threading.Thread):
                 doctest.testmod(optionflags=doctest.ELLIPSIS)
             sys.exit(failure_count)
 
-        instance = cls()
-        if args['-s'] or args['--server']:
-            instance.server_running = True
-            instance.start()
+        if args['--job']:
+            instance = JobPlayer(Job(args['--job']))
+        else:
+            instance = cls()
 
         if args['-r'] or args['--red']:
             color = RED
         else:
             color = WHITE
 
-        duration = string.atoi(args['<duration>'])
+        if args['<duration>'] is not None:
+            duration = string.atoi(args['<duration>'])
+
+        if not args['--job']:
+            instance.scale = string.atof(args['--scale'])
+
+        if args['--compile']:
+            compile_job(instance, args['--compile'], range(-20, 1000), color,
+                        processes=string.atoi(args['-j']) or None)
+            return
+
+        if args['-s'] or args['--server']:
+            instance.server_running = True
+            instance.start()
+
+        try:
+            if args['-m'] or args['--manual']:
+                instance.build_supports(color)
+                for z in range(1000):   # die on instance.stop()
+                    img = instance.render(z, color)
+                    instance.stage(img, z)
+                    instance.after_layer()
+                    instance.show(z)
+                    print z
+            elif args['--job']:
+                Pipeline(instance, range(len(instance.job)), color,
+                         lookahead=string.atoi(args['-l'])).run()
+            else:
+                Pipeline(instance, range(-20, 1000), color,
+                         lookahead=string.atoi(args['-l']),
+                         processes=string.atoi(args['-j']) or None).run()
+        finally:
+            if instance.server_running:
+                cherrypy.engine.exit()
+
+
+class JobPlayer(CherryPyServer):
+    """
+    Prints a job file (see job.py). The layers are already encoded, so
+    they are served straight out of the mapped file, and each has its own
+    exposure and platform move.
+    """
+
+    def __init__(self, job):
+        CherryPyServer.__init__(self)
+        self.job = job
+
+    def encoded(self, i, color):
+        if i >= len(self.job):
+            self.stop()
+        return self.job.layer(i), None, None
+
+    def exposure(self, i):
+        return self.job.exposure(i)
+
+    def move(self, i):
+        from arduino.stepper import SIGN
+        if self.job.steps(i):
+            self.stepper_comm().steps(SIGN * self.job.steps(i))
+
+
+def compile_job(printer, filename, zs, color, processes=1):
+    """
+    Render the layers of printer at heights zs, up to the one where it
+    calls stop(), into a job file that JobPlayer can print.
+
+    >>> import tempfile
+    >>> class Printer(CherryPyServer):
+    ...     def layer(self, z, img, duration=2000, color=WHITE):
+    ...         if z >= 2:
+    ...             self.stop()
+    ...         img.rectangle(0, 0, 10, 10, color)
+    >>> filename = tempfile.mktemp()
+    >>> compile_job(Printer(), filename, range(10), RED)
+    >>> player = JobPlayer(Job(filename))
+    >>> [player.job.z(i) for i in range(len(player.job))]
+    [0.0, 1.0]
+    >>> str(player.encoded(1, RED)[0]) == Printer().encoded(1, RED)[0]
+    True
+    >>> os.remove(filename)
+    """
+    def render(z):
+        try:
+            return z, printer.encoded(z, color)[0]
+        except SystemExit:
+            return None
+
+    layers = ordered_map(render, zs, processes)
+
+    def records():
+        for item in layers:
+            if item is None:
+                break
+            z, png = item
+            yield z, png, printer.exposure(z), LAYER_STEPS
+
+    try:
+        write_job(filename, records(), W, H)
+    finally:
+        layers.close()
+
+
+# Pipeline.stage_next found no layer ready yet
+PENDING = object()
+
+
+class Pipeline(object):
+    """
+    Runs a print as three overlapping stages. A producer thread renders
+    and encodes layers into a queue holding up to lookahead of them. The
+    display stage, in the calling thread, publishes each layer and times
+    its exposure from when the browser shows it. The next layer is staged
+    during that exposure, as soon as it is ready, so the page can load it
+    before it is shown. A motion thread moves the platform between
+    exposures. Rendering overlaps both, so the print takes about as long
+    as the exposures and moves alone.
+
+    With processes other than 1 the producer farms layers out to a pool of
+    forked processes, see parallel.ordered_map. The layers ahead are then
+    held by the pool rather than the queue, so lookahead is not counted
+    twice. Each process has its own copy of the printer, so layer() must
+    not rely on anything an earlier layer changed.
+
+    >>> class Printer(CherryPyServer):
+    ...     def layer(self, z, img, duration=2000, color=WHITE):
+    ...         if z >= 2:
+    ...             self.stop()
+    ...         img.rectangle(0, 0, 10, 10, color)
+    ...     def show(self, z):
+    ...         shown.append(z)
+    >>> shown, moved = [], []
+    >>> pipeline = Pipeline(Printer(), range(5), WHITE, move=moved.append)
+    >>> pipeline.exposure = 0
+    >>> pipeline.run()
+    0
+    1
+    >>> shown, moved
+    ([0, 1], [0, 1])
+    >>> shown = []
+    >>> pipeline = Pipeline(Printer(), range(5), WHITE, processes=2,
+    ...                     move=moved.append)
+    >>> pipeline.exposure = 0
+    >>> pipeline.run()
+    0
+    1
+    >>> shown
+    [0, 1]
+
+    The next layer is staged while the one before it is exposed:
+
+    >>> class Stager(Printer):
+    ...     def stage_encoded(self, z, encoded):
+    ...         events.append(('stage', z))
+    >>> events = []
+    >>> pipeline = Pipeline(Stager(), range(5), WHITE,
+    ...                     move=lambda z: events.append(('move', z)))
+    >>> pipeline.exposure = 0.2
+    >>> pipeline.run()
+    0
+    1
+    >>> events.index(('stage', 1)) < events.index(('move', 0))
+    True
+
+    A failed move stops the print like a failed layer does:
+
+    >>> def jam(z):
+    ...     raise IOError('stepper not responding')
+    >>> pipeline = Pipeline(Printer(), range(5), WHITE, move=jam)
+    >>> pipeline.exposure = 0
+    >>> pipeline.run()
+    Traceback (most recent call last):
+    ...
+    IOError: stepper not responding
+    """
+
+    def __init__(self, printer, zs, color, lookahead=4, move=None,
+                 processes=1):
+        self.printer = printer
+        self.zs = zs
+        self.color = color
+        self.move = move or printer.move
+        self.lookahead = lookahead
+        self.processes = processes
+        self.exposure = None     # seconds, from the printer by default
+        # The lookahead is spent in one place: the queue, or with several
+        # processes the pool, whose results then go through one at a time
+        self.layers = Queue.Queue(maxsize=lookahead if processes == 1 else 1)
+        self.moves = Queue.Queue()
+        self.moved = Queue.Queue()
+        self.error = None
+
+    @staticmethod
+    def get(queue):
+        # A plain get() would block KeyboardInterrupt on Python 2
+        while True:
+            try:
+                return queue.get(timeout=1)
+            except Queue.Empty:
+                pass
+
+    def render(self, z):
+        """
+        Render and encode layer z, or return None if there are no more.
+        """
+        try:
+            return z, self.printer.encoded(z, self.color)
+        except SystemExit:
+            return None
 
-        instance.build_supports(color)
-        for z in range(1000):   # die on StopIteration or instance.stop()
-            img = Image()
-            instance.layer(z, img, duration, color)
-            instance.after_layer()
-            img.write(z)
-            print z
+    def produce(self):
+        results = ordered_map(self.render, self.zs, self.processes,
+                              max(self.lookahead - 1, 1))
+        try:
+            for item in results:
+                if item is None:
+                    break
+                self.layers.put(item)
+        except Exception:
+            self.error = sys.exc_info()
+        finally:
+            results.close()
+        self.layers.put(None)
+
+    def motion(self):
+        try:
+            while True:
+                z = self.get(self.moves)
+                if z is None:
+                    break
+                self.move(z)
+                self.moved.put(z)
+        except Exception:
+            self.error = sys.exc_info()
+            self.moved.put(None)
+
+    def check(self):
+        """
+        Raise the error that stopped the producer or motion thread, if any.
+        """
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def stage_next(self, deadline):
+        """
+        Stage the next layer if it is ready by deadline. Returns it, None
+        if there are no more, or PENDING if it is not ready yet.
+        """
+        try:
+            item = self.layers.get(timeout=max(0, deadline - time.time()))
+        except Queue.Empty:
+            return PENDING
+        if item is not None:
+            self.printer.stage_encoded(*item)
+        return item
+
+    def expose(self, z):
+        """
+        Expose layer z, staging the next one meanwhile, which is returned
+        as by stage_next.
+        """
+        exposure = self.exposure
+        if exposure is None:
+            exposure = self.printer.exposure(z) / 1000.0
+        # Without word from the browser, time the exposure from when the
+        # layer was published, not from when we gave up waiting
+        published = time.time()
+        following = self.stage_next(published + exposure)
+        shown = None
+        if self.printer.server_running:
+            shown = self.printer.frames.wait_displayed(z)
+        if shown is None:
+            shown = published
+        time.sleep(max(0, shown + exposure - time.time()))
+        return following
+
+    def run(self):
+        producer = threading.Thread(target=self.produce)
+        motion = threading.Thread(target=self.motion)
+        for thread in (producer, motion):
+            thread.daemon = True
+            thread.start()
+        moving = False
+        try:
+            item = PENDING
+            while True:
+                if item is PENDING:
+                    item = self.get(self.layers)
+                    self.check()
+                    if item is not None:
+                        self.printer.stage_encoded(*item)
+                if item is None:
+                    break
+                z = item[0]
+                if moving:
+                    self.get(self.moved)
+                    self.check()
+                self.printer.show(z)
+                item = self.expose(z)
+                self.moves.put(z)
+                moving = True
+                print z
+            if moving:
+                self.get(self.moved)
+        finally:
+            self.moves.put(None)
+            while motion.is_alive():    # let a move in progress finish
+                motion.join(1)
+        self.check()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+
+"""
+Usage:
+  CMD (-T | --test) [-v | --verbose]
+"""
+
+import docopt
+import hashlib
+import numpy
+import os
+import struct
+import sys
+import zlib
+
+WHITE = '\xff\xff\xff'
+RED = '\xff\x00\x00'
+BLACK = '\x00\x00\x00'
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+# zlib's run-length strategy, which Python 2 does not name
+Z_RLE = 3
+
+# Header of a span-encoded layer: magic, index, base index (-1 for a
+# keyframe), width, height, color, span count
+SPANS_HEADER = struct.Struct('<4siiHH3sxI')
+SPANS_MAGIC = 'SPN1'
+
+
+class Frame(object):
+    """
+    An RGB frame buffer of height rows by width pixels, three bytes per
+    pixel, held in one preallocated numpy array. Spans are painted with
+    slice assignment or in batches, never by rebuilding the buffer.
+
+    >>> f = Frame(4, 2)
+    >>> f.span(1, 3, 0, RED)
+    >>> f.tostring()[:12] == BLACK + RED + RED + BLACK
+    True
+    >>> len(f.tostring())
+    24
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.pixels = numpy.zeros((height, width, 3), dtype=numpy.uint8)
+
+    @staticmethod
+    def rgb(color):
+        return numpy.frombuffer(color, dtype=numpy.uint8)
+
+    def span(self, x1, x2, y, color=WHITE):
+        """
+        Paint pixels x1 <= x < x2 of row y.
+        """
+        self.pixels[y, x1:x2] = self.rgb(color)
+
+    def spans(self, ys, x1s, x2s, color=WHITE):
+        """
+        Paint many spans at once: pixels x1s[i] <= x < x2s[i] of row ys[i]
+        for every i. Spans may overlap and are clipped to the frame.
+
+        >>> f = Frame(5, 3)
+        >>> f.spans([0, 0, 2, 9], [0, 1, -3, 0], [2, 4, 1, 5])
+        >>> f.mask().astype(int).tolist()
+        [[1, 1, 1, 1, 0], [0, 0, 0, 0, 0], [1, 0, 0, 0, 0]]
+        """
+        ys = numpy.asarray(ys, dtype=numpy.intp)
+        x1s = numpy.asarray(x1s, dtype=numpy.intp).clip(0, self.width)
+        x2s = numpy.asarray(x2s, dtype=numpy.intp).clip(0, self.width)
+        keep = (0 <= ys) & (ys < self.height) & (x1s < x2s)
+        ys, x1s, x2s = ys[keep], x1s[keep], x2s[keep]
+        if len(ys) == 0:
+            return
+        # Mark where each span starts and stops, then a running sum along
+        # each row says how many spans cover each pixel. Only the rows
+        # between the first and last span are touched.
+        top, bottom = ys.min(), ys.max() + 1
+        edges = numpy.zeros((bottom - top, self.width + 1), dtype=numpy.int32)
+        numpy.add.at(edges, (ys - top, x1s), 1)
+        numpy.add.at(edges, (ys - top, x2s), -1)
+        mask = edges.cumsum(axis=1)[:, :-1] > 0
+        self.pixels[top:bottom][mask] = self.rgb(color)
+
+    def fill(self, mask, color=WHITE):
+        """
+        Paint every pixel where the height x width boolean mask is set.
+        """
+        self.pixels[mask] = self.rgb(color)
+
+    def mask(self):
+        """
+        Boolean height x width array of the pixels that are not black.
+        """
+        return self.pixels.any(axis=2)
+
+    def tostring(self):
+        return self.pixels.tostring()
+
+    def digest(self):
+        """
+        SHA-1 of the pixels, to spot a frame that repeats an earlier one.
+
+        >>> a, b = Frame(4, 2), Frame(4, 2)
+        >>> a.span(0, 2, 1, RED)
+        >>> a.digest() == b.digest()
+        False
+        >>> b.span(0, 2, 1, RED)
+        >>> a.digest() == b.digest()
+        True
+        """
+        return hashlib.sha1(self.pixels).digest()
+
+    def color(self):
+        """
+        The color of the frame as a 3-byte string if every lit pixel has
+        the same one, BLACK if none is lit, otherwise None.
+
+        >>> f = Frame(4, 2)
+        >>> f.color() == BLACK
+        True
+        >>> f.span(0, 2, 0, RED)
+        >>> f.color() == RED
+        True
+        >>> f.span(3, 4, 1, WHITE)
+        >>> f.color()
+        """
+        lit = self.pixels[self.mask()]
+        if len(lit) == 0:
+            return BLACK
+        if (lit != lit[0]).any():
+            return None
+        return lit[0].tostring()
+
+    def png(self, level=6):
+        """
+        Encode the frame as an 8-bit RGB PNG. Every row uses the "up"
+        filter, so a row that repeats the one above it becomes zeros, and
+        the filtered data is deflated with zlib's run-length strategy,
+        which suits mostly-black layers made of long runs.
+
+        >>> f = Frame(3, 2)
+        >>> f.span(0, 2, 1, RED)
+        >>> data = f.png()
+        >>> data[:8] == PNG_SIGNATURE
+        True
+        >>> width, height, depth, kind = struct.unpack('>IIBB', data[16:26])
+        >>> width, height, depth, kind
+        (3, 2, 8, 2)
+        >>> raw = zlib.decompress(data[41:-16])
+        >>> [ord(c) for c in raw]
+        [2, 0, 0, 0, 0, 0, 0, 0, 0, 0, 2, 255, 0, 0, 255, 0, 0, 0, 0, 0]
+        """
+        rows = self.pixels.reshape(self.height, 3 * self.width)
+        filtered = numpy.empty((self.height, 3 * self.width + 1),
+                               dtype=numpy.uint8)
+        filtered[:, 0] = 2
+        filtered[0, 1:] = rows[0]
+        filtered[1:, 1:] = rows[1:] - rows[:-1]    # wraps modulo 256
+        compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS,
+                                      8, Z_RLE)
+        idat = compressor.compress(filtered.tostring()) + compressor.flush()
+        header = struct.pack('>IIBBBBB', self.width, self.height,
+                             8, 2, 0, 0, 0)
+        return (PNG_SIGNATURE + png_chunk('IHDR', header) +
+                png_chunk('IDAT', idat) + png_chunk('IEND', ''))
+
+
+def mask_runs(mask):
+    """
+    The horizontal runs of True in a 2-D boolean array as arrays of rows,
+    starts and (exclusive) ends, in row-major order.
+
+    >>> ys, x1s, x2s = mask_runs(numpy.array([[1, 1, 0, 1], [0, 0, 0, 0],
+    ...                                       [0, 1, 1, 1]], dtype=bool))
+    >>> zip(ys.tolist(), x1s.tolist(), x2s.tolist())
+    [(0, 0, 2), (0, 3, 4), (2, 1, 4)]
+    """
+    height, width = mask.shape
+    padded = numpy.zeros((height, width + 2), dtype=numpy.int8)
+    padded[:, 1:-1] = mask
+    d = numpy.diff(padded, axis=1)
+    ys, x1s = numpy.nonzero(d == 1)
+    _, x2s = numpy.nonzero(d == -1)
+    return ys, x1s, x2s
+
+
+def encode_spans(index, mask, color, base=None, base_mask=None):
+    """
+    Encode a single-colored layer as runs of lit pixels. Given the mask of
+    an earlier layer, encode only the runs where the two differ, which
+    the client toggles; consecutive layers of a part usually differ in
+    few places. The result is SPANS_HEADER followed by little-endian
+    uint16 (row, start, end) triples.
+
+    >>> a = numpy.array([[1, 1, 0, 0], [0, 0, 0, 0]], dtype=bool)
+    >>> b = numpy.array([[1, 1, 1, 0], [0, 0, 0, 0]], dtype=bool)
+    >>> data = encode_spans(7, b, RED)
+    >>> SPANS_HEADER.unpack(data[:SPANS_HEADER.size]) == \\
+    ...     (SPANS_MAGIC, 7, -1, 4, 2, RED, 1)
+    True
+    >>> numpy.frombuffer(data[SPANS_HEADER.size:], '<u2').tolist()
+    [0, 0, 3]
+    >>> data = encode_spans(7, b, RED, 6, a)
+    >>> SPANS_HEADER.unpack(data[:SPANS_HEADER.size])[2]
+    6
+    >>> numpy.frombuffer(data[SPANS_HEADER.size:], '<u2').tolist()
+    [0, 2, 3]
+    """
+    if base_mask is None:
+        base = -1
+    else:
+        mask = mask ^ base_mask
+    ys, x1s, x2s = mask_runs(mask)
+    height, width = mask.shape
+    spans = numpy.empty((len(ys), 3), dtype='<u2')
+    spans[:, 0], spans[:, 1], spans[:, 2] = ys, x1s, x2s
+    return (SPANS_HEADER.pack(SPANS_MAGIC, index, base, width, height,
+                              color, len(ys)) + spans.tostring())
+
+
+def png_chunk(kind, data):
+    crc = zlib.crc32(kind + data) & 0xffffffff
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', crc)
+
+
+def atomic_write(filename, data):
+    """
+    Write data to a temporary file next to filename and rename it into
+    place, so readers see either the old contents or the new, never a
+    partly written file.
+    """
+    tmp = '{0}.{1}.tmp'.format(filename, os.getpid())
+    with open(tmp, 'wb') as outf:
+        outf.write(data)
+    os.rename(tmp, filename)
+
+
+def point_spans(points):
+    """
+    Turn a sorted (point, normal) list from Stl.getPointList into (x1, x2)
+    spans of solid. Each span starts at a crossing whose normal points
+    back along x and ends at the next crossing. Spans stop at the first
+    pair that does not start that way.
+
+    >>> from geom3d import Vector
+    >>> inside, outside = Vector(-1, 0, 0), Vector(1, 0, 0)
+    >>> point_spans([(Vector(0, 0, 0), inside), (Vector(1, 0, 0), outside),
+    ...              (Vector(2, 0, 0), inside), (Vector(3, 0, 0), outside)])
+    [(0, 1), (2, 3)]
+    >>> point_spans([(Vector(0, 0, 0), outside), (Vector(1, 0, 0), inside),
+    ...              (Vector(2, 0, 0), inside), (Vector(3, 0, 0), outside)])
+    []
+    """
+    spans = []
+    for j in range(0, len(points) - 1, 2):
+        if not points[j][1].x < 0:
+            # TODO figure out what to do
+            break
+        assert points[j+1][1].x > 0, points
+        spans.append((points[j][0].x, points[j+1][0].x))
+    return spans
+
+
+def ray_spans(rays, xs, nxs):
+    """
+    point_spans for the crossings of many lines at once, given as arrays
+    of the line, the x coordinate and the x component of the normal,
+    sorted by line and then x. Returns arrays of the line and the start
+    and end of each span.
+
+    >>> rays, x1s, x2s = ray_spans(numpy.array([0, 0, 0, 0, 1, 1, 2, 2]),
+    ...                            numpy.array([0., 1, 2, 3, 0, 1, 0, 1]),
+    ...                            numpy.array([-1., 1, -1, 1, 1, -1, -1, 1]))
+    >>> zip(rays.tolist(), x1s.tolist(), x2s.tolist())
+    [(0, 0.0, 1.0), (0, 2.0, 3.0), (2, 0.0, 1.0)]
+    """
+    n = len(rays)
+    if n == 0:
+        return rays, xs, xs
+    first = numpy.r_[True, rays[1:] != rays[:-1]]
+    starts = numpy.flatnonzero(first)
+    line = numpy.cumsum(first) - 1
+    pos = numpy.arange(n) - starts[line]
+    # A span may start at every other crossing that has one after it on
+    # the same line, but the line stops at the first that does not start
+    # going back along x.
+    candidate = (pos % 2 == 0) & numpy.r_[rays[1:] == rays[:-1], False]
+    bad = candidate & ~(nxs < 0)
+    seen = numpy.cumsum(bad)
+    seen -= (seen - bad)[starts][line]
+    j = numpy.flatnonzero(candidate & (seen == 0))
+    assert (nxs[j + 1] > 0).all(), (rays[j], xs[j])
+    return rays[j], xs[j], xs[j + 1]
+
+
+def main():
+    args = docopt.docopt(__doc__.replace('CMD', sys.argv[0]))
+
+    if args['-T'] or args['--test']:
+        import doctest
+        verbose = args['-v'] or args['--verbose']
+        failure_count, _ = doctest.testmod(verbose=verbose,
+                                           optionflags=doctest.ELLIPSIS)
+        sys.exit(failure_count)
+
+
+if __name__ == '__main__':
+    main()
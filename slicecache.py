@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+"""
+Usage:
+  CMD (-T | --test) [-v | --verbose]
+"""
+
+import docopt
+import hashlib
+import numpy
+import os
+import sys
+import time
+from raster import atomic_write
+
+# Each entry is a file named by its key holding the magic, the SHA-1 of
+# the data, then the data
+ENTRY_MAGIC = 'SLC1'
+ENTRY_HEADER = len(ENTRY_MAGIC) + 20
+
+# Default size limit
+MAX_BYTES = 1 << 30
+
+
+class SliceCache(object):
+    """
+    Rendered layers and contours kept on disk between runs. Entries are
+    addressed by a hash of everything that determines them, starting
+    with the mesh digest, so a part that is printed again is not sliced
+    again. When the cache grows past max_bytes the entries used least
+    recently are removed. An entry that fails its checksum is removed
+    and treated as missing.
+
+    >>> import shutil, tempfile
+    >>> cache = SliceCache(tempfile.mkdtemp(), max_bytes=250)
+    >>> key = cache.key('mesh', 'rgb', 0.5, 4, 2)
+    >>> cache.get(key)
+    >>> cache.put(key, 'x' * 100)
+    >>> cache.get(key) == 'x' * 100
+    True
+    >>> cache.put(cache.key('mesh', 'rgb', 1.0, 4, 2), 'y' * 100)
+    >>> cache.get(key) == 'x' * 100
+    True
+    >>> cache.put(cache.key('mesh', 'rgb', 1.5, 4, 2), 'z' * 100)
+    >>> cache.get(cache.key('mesh', 'rgb', 1.0, 4, 2))
+    >>> cache.get(key) == 'x' * 100
+    True
+    >>> with open(cache.path(key), 'r+b') as f:
+    ...     f.seek(-1, 2)
+    ...     f.write('!')
+    >>> cache.get(key)
+    >>> os.path.exists(cache.path(key))
+    False
+    >>> shutil.rmtree(cache.directory)
+    """
+
+    def __init__(self, directory, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.size = sum(os.path.getsize(path) for path in self.entries())
+
+    @staticmethod
+    def key(*params):
+        """
+        The key for an entry determined by params, which should start with
+        the mesh digest and what kind of entry it is. Floats are keyed by
+        their repr, so heights must be computed the same way each time.
+        """
+        return hashlib.sha1(repr(params)).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:])
+
+    def entries(self):
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for name in filenames:
+                if not name.endswith('.tmp'):
+                    yield os.path.join(dirpath, name)
+
+    def get(self, key):
+        """
+        The data stored under key, or None.
+        """
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as inf:
+                entry = inf.read()
+        except IOError:
+            return None
+        data = entry[ENTRY_HEADER:]
+        if entry[:ENTRY_HEADER] != ENTRY_MAGIC + hashlib.sha1(data).digest():
+            self.remove(path)
+            return None
+        touch(path)
+        return data
+
+    def put(self, key, data):
+        path = self.path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if os.path.exists(path):
+            self.size -= os.path.getsize(path)
+        atomic_write(path, ENTRY_MAGIC + hashlib.sha1(data).digest() + data)
+        touch(path)
+        self.size += ENTRY_HEADER + len(data)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        self.size -= size
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in
+        max_bytes. Other processes may share the directory, so it is
+        measured again first.
+        """
+        entries = []
+        for path in self.entries():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, path, st.st_size))
+        entries.sort()
+        self.size = sum(size for _, _, size in entries)
+        for _, path, size in entries:
+            if self.size <= self.max_bytes:
+                break
+            self.remove(path)
+
+
+def touch(path):
+    """
+    Mark path as just used. The time is given explicitly because the
+    kernel's own timestamps are too coarse to order entries used in
+    quick succession.
+    """
+    now = time.time()
+    os.utime(path, (now, now))
+
+
+def encode_contours(contours):
+    """
+    Pack Layer.contours() into a string: the number of polygons, their
+    lengths, then the points as float64.
+
+    >>> contours = [[(0.0, 0.0), (1.0, 0.0), (0.0, 1.0), (0.0, 0.0)],
+    ...             [(2.0, 2.0), (3.0, 3.0)]]
+    >>> decode_contours(encode_contours(contours)) == contours
+    True
+    >>> decode_contours(encode_contours([]))
+    []
+    """
+    lengths = numpy.array([len(c) for c in contours], dtype='<i4')
+    points = numpy.array([p for c in contours for p in c], dtype='<f8')
+    return (numpy.array([len(lengths)], dtype='<i4').tostring() +
+            lengths.tostring() + points.tostring())
+
+
+def decode_contours(data):
+    n, = numpy.frombuffer(data, dtype='<i4', count=1)
+    lengths = numpy.frombuffer(data, dtype='<i4', count=n, offset=4)
+    points = numpy.frombuffer(data, dtype='<f8', offset=4 + 4 * n)
+    points = [tuple(p) for p in points.reshape(-1, 2).tolist()]
+    contours = []
+    for length in lengths.tolist():
+        contours.append(points[:length])
+        points = points[length:]
+    return contours
+
+
+def main():
+    args = docopt.docopt(__doc__.replace('CMD', sys.argv[0]))
+
+    if args['-T'] or args['--test']:
+        import doctest
+        verbose = args['-v'] or args['--verbose']
+        failure_count, _ = doctest.testmod(verbose=verbose,
+                                           optionflags=doctest.ELLIPSIS)
+        sys.exit(failure_count)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,43 +2,275 @@
 
 """
 Usage:
-  CMD -z <ZVALUE> -f <filename> [-p | --profile]
+  CMD -z <ZVALUE> -f <filename> [-p | --profile] [-m | --mmap] [options]
+  CMD slice -f <filename> --z-start=<z> --z-step=<dz> --count=<n>
+      --out=<dir> [--raw] [-j <processes>] [-m | --mmap]
+      [--cache=<dir>] [--cache-size=<MB>] [options]
   CMD (-T | --test) [-v | --verbose]
 
+Options:
+  --width=<pixels>   Frame width [default: 1024].
+  --height=<pixels>  Frame height [default: 768].
+  --red              Draw the part in red rather than white.
+  --scale=<ppu>      Pixels per STL unit, centered on the part. By default
+                     the part is fitted to the frame.
+  --rotate=<x,y,z>   Turn the part by these angles in degrees about the x,
+                     y and z axes, in that order, before slicing.
+  --fit              Center the part on the build area, resting on z = 0,
+                     and shrink it if it does not fit at --scale.
+  --raw              Write raw RGB frames rather than PNGs.
+  -j <processes>     Render layers in this many processes, 0 for one per
+                     core [default: 1].
+  --cache=<dir>      Keep rendered layers in this directory and reuse them
+                     when the same part is sliced the same way again.
+  --cache-size=<MB>  Size limit of the cache [default: 1024].
+
 Example:
   ./stl.py -z 4 -f example.stl > example.rgb
   convert -size 1024x768 -alpha off -depth 8 example.rgb example-0004.png
+  ./stl.py slice -f example.stl --z-start=0.1 --z-step=0.1 --count=100 \\
+      --out=layers/
 """
 
 import docopt
+import numpy
+import os
 import string
 import struct
 import sys
 import types
-from geom3d import Triangle, BBox, Vector
+from geom3d import BBox, Triangle, Vector, rotation, scaling, translation
+from mesh import Mesh, LazyMesh, Layer, TriangleView
+from parallel import ordered_map
+from raster import Frame, atomic_write, RED, WHITE
+from slicecache import SliceCache, decode_contours, encode_contours
+
+# One 50-byte binary STL triangle record
+STL_RECORD = numpy.dtype([('normal', '<f4', (3,)),
+                          ('vertices', '<f4', (3, 3)),
+                          ('attribute', '<u2')])
+
+# Bytes of ASCII STL text read at a time
+ASCII_CHUNK = 1 << 22
+
+# Bytes read from the start of a file to tell ASCII STL from binary
+ASCII_PROBE = 512
+
+
+def is_ascii(header, size):
+    """
+    Decide from the first bytes of a file, at least 84 of them where there
+    are that many, and the file size whether it is ASCII STL. Some binary
+    exporters also start the preamble with "solid", so a file with room
+    for the records its count promises, and no facet or vertex after the
+    84-byte header, is binary even if it has bytes left over.
+
+    >>> is_ascii('solid cube\\n  facet normal 0 0 1\\n', 1000)
+    True
+    >>> is_ascii('solid'.ljust(80) + struct.pack('<I', 2), 184)
+    False
+    >>> is_ascii('solid'.ljust(80) + struct.pack('<I', 2) + '\\0' * 107, 191)
+    False
+    >>> is_ascii('solid part\\n' + 'facet normal 0 0 1 outer loop vertex'
+    ...          ' 0 0 0 vertex 1 0 0 vertex 1 1 0 endloop endfacet', 400)
+    True
+    >>> is_ascii('\\0' * 80 + struct.pack('<I', 2), 1000)
+    False
+    """
+    if not header.lstrip().startswith('solid'):
+        return False
+    if len(header) < 84:
+        return True
+    count, = struct.unpack_from('<I', header, 80)
+    if size < 84 + STL_RECORD.itemsize * count:
+        return True
+    return bool(set(header[84:].split()) & set(['facet', 'vertex']))
+
+
+def ascii_blocks(inf, rest='', size=ASCII_CHUNK):
+    """
+    Yield successive pieces of ASCII STL text from a file, each ending on a
+    facet boundary, reading size bytes at a time.
+
+    >>> from StringIO import StringIO
+    >>> f = StringIO('solid x facet normal 0 0 1 endfacet facet endfacet')
+    >>> list(ascii_blocks(f, size=16))
+    ['solid x facet normal 0 0 1 endfacet', ' facet endfacet']
+    """
+    while True:
+        chunk = inf.read(size)
+        if not chunk:
+            break
+        text = rest + chunk
+        end = text.rfind('endfacet')
+        if end < 0:
+            rest = text
+            continue
+        end += len('endfacet')
+        rest = text[end:]
+        yield text[:end]
+    if rest.strip():
+        yield rest
+
+
+def ascii_facets(blocks):
+    """
+    Turn pieces of ASCII STL text into (normals, vertices) arrays of shape
+    (n, 3) and (n, 3, 3), one pair per piece.
 
+    >>> text = '''facet normal 0 0 1
+    ...   outer loop
+    ...     vertex 0 0 0
+    ...     vertex 1 0 0
+    ...     vertex 1 1 0
+    ...   endloop
+    ... endfacet'''
+    >>> [(n.tolist(), v[0].tolist()) for n, v in ascii_facets([text])]
+    [([[0.0, 0.0, 1.0]], [[0.0, 0.0, 0.0], [1.0, 0.0, 0.0], [1.0, 1.0, 0.0]])]
+    >>> list(ascii_facets(['facet normal 0 0 1 outer loop vertex 0 0 0']))
+    Traceback (most recent call last):
+    ...
+    ValueError: malformed ASCII STL facet
+    """
+    keys = numpy.array(['normal', 'vertex', 'vertex', 'vertex'])
+    for block in blocks:
+        tokens = numpy.array(block.split(), dtype=str)
+        idx = numpy.flatnonzero((tokens == 'normal') | (tokens == 'vertex'))
+        if len(idx) == 0:
+            continue
+        if len(idx) % 4 or idx[-1] + 3 >= len(tokens) or \
+                (tokens[idx].reshape(-1, 4) != keys).any():
+            raise ValueError('malformed ASCII STL facet')
+        values = tokens[idx[:, numpy.newaxis] + numpy.arange(1, 4)]
+        values = values.astype(numpy.float64).reshape(-1, 4, 3)
+        yield values[:, 0], values[:, 1:]
 
-class Stl:
-    def __init__(self, *args):
+
+def read_ascii(inf):
+    """
+    Parse an ASCII STL file a chunk at a time, returning the solid name
+    and a Mesh. Only one chunk of text is held in memory at once. A file
+    without a single facet is rejected with ValueError.
+
+    >>> from StringIO import StringIO
+    >>> preamble, mesh = read_ascii(StringIO('''solid tri
+    ... facet normal 0 0 1
+    ...   outer loop
+    ...     vertex 0 0 0
+    ...     vertex 1 0 0
+    ...     vertex 1 1 0
+    ...   endloop
+    ... endfacet
+    ... endsolid tri
+    ... '''))
+    >>> preamble, len(mesh), mesh.bbox()
+    ('tri', 1, <BBox <0.0,0.0,0.0> <1.0,1.0,0.0>>)
+    >>> read_ascii(StringIO('solid empty\\nendsolid empty\\n'))
+    Traceback (most recent call last):
+    ...
+    ValueError: ASCII STL has no facets
+    """
+    first = inf.readline()
+    preamble = first.strip()[len('solid'):].strip()
+    normals, vertices = [numpy.zeros((0, 3))], [numpy.zeros((0, 3, 3))]
+    for n, v in ascii_facets(ascii_blocks(inf, first)):
+        normals.append(n)
+        vertices.append(v)
+    if len(normals) == 1:
+        raise ValueError('ASCII STL has no facets')
+    return preamble, Mesh(numpy.concatenate(vertices),
+                          numpy.concatenate(normals))
+
+
+def read_binary(data):
+    """
+    Decode a binary STL held in a string or buffer, returning the preamble
+    and a Mesh. All the triangle records are decoded in one pass straight
+    out of the buffer. Bytes after the last record are ignored.
+
+    >>> record = struct.pack('<12fH', 0, 0, 1, 0, 0, 0, 1, 0, 0, 1, 1, 0, 0)
+    >>> preamble, mesh = read_binary('hello'.ljust(80, '\\0') +
+    ...                              struct.pack('<I', 2) + 2 * record)
+    >>> preamble, len(mesh)
+    ('hello', 2)
+    >>> mesh.vertices[1].tolist()
+    [[0.0, 0.0, 0.0], [1.0, 0.0, 0.0], [1.0, 1.0, 0.0]]
+    >>> len(read_binary('hello'.ljust(80, '\\0') + struct.pack('<I', 1) +
+    ...                 record + '\\0' * 7)[1])
+    1
+    >>> read_binary('hello'.ljust(80, '\\0') + struct.pack('<I', 3) + record)
+    Traceback (most recent call last):
+    ...
+    ValueError: binary STL with 3 triangles should be 234 bytes, not 134
+    """
+    if len(data) < 84:
+        raise ValueError('binary STL is only {0} bytes'.format(len(data)))
+    count, = struct.unpack_from('<I', data, 80)
+    expected = 84 + STL_RECORD.itemsize * count
+    if len(data) < expected:
+        raise ValueError('binary STL with {0} triangles should be {1} bytes,'
+                         ' not {2}'.format(count, expected, len(data)))
+    preamble = str(data[:80]).replace('\0', '')
+    records = numpy.frombuffer(data, dtype=STL_RECORD, count=count, offset=84)
+    return preamble, Mesh(records['vertices'], records['normal'])
+
+
+def map_binary(filename):
+    """
+    Open a binary STL without reading the triangles, returning the preamble
+    and a LazyMesh over a memory map of the records. Bytes after the last
+    record are ignored.
+    """
+    with open(filename, 'rb') as inf:
+        header = inf.read(84)
+        size = os.fstat(inf.fileno()).st_size
+    if len(header) < 84:
+        raise ValueError('binary STL is only {0} bytes'.format(size))
+    count, = struct.unpack_from('<I', header, 80)
+    expected = 84 + STL_RECORD.itemsize * count
+    if size < expected:
+        raise ValueError('binary STL with {0} triangles should be {1} bytes,'
+                         ' not {2}'.format(count, expected, size))
+    preamble = header[:80].replace('\0', '')
+    if count == 0:
+        return preamble, Mesh(numpy.zeros((0, 3, 3)))
+    records = numpy.memmap(filename, dtype=STL_RECORD, mode='r',
+                           offset=84, shape=(count,))
+    return preamble, LazyMesh(records)
+
+
+class Stl(object):
+    """
+    Stl(filename) reads an STL file, binary or ASCII. Stl(filename,
+    mmap=True) maps a binary file instead and decodes triangles only as
+    queries need them, so opening is immediate and memory is bounded by the
+    layer being sliced. ASCII files are always parsed.
+    Stl(triangle, ...) builds one from geom3d.Triangles.
+    """
+    def __init__(self, *args, **kwargs):
         if type(args[0]) in (types.StringType, types.UnicodeType):
             self.filename = args[0]
-            self.triangles = []
-            R = open(self.filename).read()
-            self.preamble = ''.join(filter(lambda ch: ch != '\0', list(R[:80])))
-            R = R[80:]
-            numTriangles, R = struct.unpack('I', R[:4])[0], R[4:]
-            triangleList = []
-            for i in range(numTriangles):
-                tri, R = self.triangle_from_string(R)
-                triangleList.append(tri)
+            with open(self.filename, 'rb') as inf:
+                header = inf.read(ASCII_PROBE)
+                inf.seek(0)
+                size = os.fstat(inf.fileno()).st_size
+                if is_ascii(header, size):
+                    self.preamble, self.mesh = read_ascii(inf)
+                elif kwargs.get('mmap'):
+                    self.preamble, self.mesh = map_binary(self.filename)
+                else:
+                    self.preamble, self.mesh = read_binary(inf.read())
         else:
             self.filename = self.preamble = None
-            triangleList = args
-        self.triangles = triangleList
-        bb = BBox()
-        for tri in triangleList:
-            bb = bb.expand(tri._bbox)
-        self._bbox = bb
+            self.mesh = Mesh.from_triangles(args)
+
+    @property
+    def _bbox(self):
+        return self.mesh.bbox()
+
+    @property
+    def triangles(self):
+        return TriangleView(self.mesh)
 
     @classmethod
     def triangle_from_string(cls, str):
@@ -81,9 +313,59 @@ class Stl:
     def bbox(self):
         return self._bbox
 
+    def digest(self):
+        return self.mesh.digest()
+
+    def transform(self, matrix):
+        """
+        Move, scale or turn the part by a 4x4 matrix, see Mesh.transform.
+        The digest follows the geometry, so layers cached before the move
+        are not reused.
+
+        >>> from geom3d import rotation
+        >>> stl = Stl(Triangle(Vector(0, 0, 0), Vector(1, 0, 0),
+        ...                    Vector(1, 0, 1)))
+        >>> before = stl.digest()
+        >>> stl.transform(rotation('z', 90))
+        >>> stl.bbox()
+        <BBox <0.0,0.0,0.0> <0.0,1.0,1.0>>
+        >>> stl.digest() == before
+        False
+        """
+        self.mesh = self.mesh.transform(matrix)
+
+    def fit(self, width, height, scale):
+        """
+        Put the part in the middle of the build area a width by height
+        frame shows at scale pixels per unit, resting on z = 0, shrinking
+        it evenly if it would not fit. Returns how much it was shrunk.
+
+        >>> stl = Stl(Triangle(Vector(0, 0, 0), Vector(4, 0, 0),
+        ...                    Vector(4, 2, 3)))
+        >>> stl.fit(11, 11, 2)
+        1.0
+        >>> stl.bbox()
+        <BBox <-2.0,-1.0,0.0> <2.0,1.0,3.0>>
+        >>> stl.fit(5, 11, 2)
+        0.5
+        >>> stl.bbox()
+        <BBox <-1.0,-0.5,0.0> <1.0,0.5,1.5>>
+        """
+        bbox = self.bbox()
+        size = bbox.size()
+        shrink = 1.0
+        for extent, pixels in ((size.x, width), (size.y, height)):
+            if extent * scale > pixels - 1:
+                shrink = min(shrink, (pixels - 1) / float(scale) / extent)
+        center = bbox._min.add(bbox._max).scale(0.5)
+        self.transform(numpy.dot(scaling(shrink),
+                                 translation(-center.x, -center.y,
+                                             -bbox._min.z)))
+        return shrink
+
     def __repr__(self):
         return '<Stl "{0}" {1} triangles>'.format(self.filename,
-                                                  len(self.triangles))
+                                                  len(self.mesh))
 
     def dump(self):
         r = repr(self) + '\n'
@@ -93,10 +375,9 @@ class Stl:
 
     def getPointList(self, y, z):
         """
-        It would be more efficient to pre-sort the triangles into
-        coarse (y,z) buckets and use those buckets to filter a smaller
-        set of triangles. But I don't need that efficiency yet and
-        likely that would be a bit of work.
+        The triangles are pre-sorted into coarse (y,z) buckets the first
+        time this is called, and after that only the triangles in the
+        bucket for (y,z) are tested, see Mesh.grid and Mesh.point_list.
         >>> A = Vector(0, 0, 0)
         >>> B = Vector(1, 0, 0)
         >>> C = Vector(0, 1, 0)
@@ -114,50 +395,173 @@ class Stl:
         >>> stl.getPointList(0.25, 0.25)
         [(<-0.0,0.25,0.25>, <...>), (<0.5,0.25,0.25>, <...>)]
         """
-        xs = []
-        points = {}
-        for triangle in self.triangles:
-            if triangle._bbox.contains_yz(y, z):
-                I = triangle.intersect(y, z)
-                if I is not None:
-                    x = I[0].x
-                    xs.append(x)
-                    points[x] = I
-        xs.sort()
-        return [points[x] for x in xs]
+        return self.mesh.point_list(y, z)
+
+    def getPointLists(self, ys, z):
+        """
+        getPointList for each of ys at once, see Mesh.point_lists.
+        """
+        return self.mesh.point_lists(ys, z)
+
+    def layers(self, z_start, z_step, count):
+        """
+        Yield a mesh.Layer for each of count heights, starting at z_start
+        and z_step apart, sweeping up through the triangles once rather
+        than testing the whole mesh at every height.
+        >>> A = Vector(0, 0, 0)
+        >>> B = Vector(1, 0, 0)
+        >>> C = Vector(0, 1, 0)
+        >>> D = Vector(0, 0, 1)
+        >>> stl = Stl(Triangle(A, B, D),
+        ...           Triangle(A, C, B),
+        ...           Triangle(A, D, C),
+        ...           Triangle(B, C, D))
+        >>> for layer in stl.layers(0.25, 0.5, 3):
+        ...     print layer
+        <Layer z=0.25 3 triangles>
+        <Layer z=0.75 3 triangles>
+        <Layer z=1.25 0 triangles>
+        """
+        zs = (z_start + i * z_step for i in range(count))
+        return self.mesh.layers(zs)
 
     def make_layer(self, z, xsteps, ysteps, bbox, red):
-        str = ''
-        for y in bbox.getYiterator(ysteps):
-            points = self.getPointList(y, z)
-
-            def isMarked(x, points=points, n=len(points)):
-                for j in range(0, n-1, 2):
-                    if points[j][1].x < 0:
-                        assert points[j+1][1].x > 0, points
-                        if points[j][0].x <= x <= points[j+1][0].x:
-                            return True
-                    else:
-                        # TODO figure out what to do
-                        return False
-                return False
-
-            for x in bbox.getXiterator(xsteps):
-
-                if isMarked(x):
-                    if red:
-                        str += '\xff\x00\x00'
-                    else:
-                        str += '\xff\xff\xff'
-                else:
-                    str += '\x00\x00\x00'
+        return self.render(Layer(z, self.mesh.layer(z)), xsteps, ysteps, bbox,
+                           red)
 
-        return str
+    def make_layers(self, z_start, z_step, count, xsteps, ysteps, bbox, red,
+                    processes=1, lookahead=None, png=False, cache=None):
+        """
+        Yield (z, rgb) for each layer of Stl.layers, or (z, png) with png.
+        With processes other than 1 the layers are rendered in that many
+        forked processes (one per core for None), which share the mesh,
+        see parallel.ordered_map. Layers found in cache, a SliceCache, are
+        not rendered again, and a layer that comes out the same as the one
+        before is not encoded again.
 
+        >>> A = Vector(0, 0, 0)
+        >>> B = Vector(1, 0, 0)
+        >>> C = Vector(0, 1, 0)
+        >>> D = Vector(0, 0, 1)
+        >>> stl = Stl(Triangle(A, B, D),
+        ...           Triangle(A, C, B),
+        ...           Triangle(A, D, C),
+        ...           Triangle(B, C, D))
+        >>> bbox = stl.bbox()
+        >>> serial = list(stl.make_layers(0.1, 0.2, 5, 8, 8, bbox, False))
+        >>> serial == list(stl.make_layers(0.1, 0.2, 5, 8, 8, bbox, False,
+        ...                                processes=2, lookahead=3))
+        True
+        """
+        if cache is not None:
+            params = (self.digest(), 'png' if png else 'rgb', xsteps, ysteps,
+                      bbox._min.x, bbox._min.y, bbox._max.x, bbox._max.y,
+                      bool(red))
 
-def generateRgb(z, filename, red, width=1024, height=768):
-    stl = Stl(filename)
-    bbox = stl._bbox.copy()
+        last = [None, None]     # digest and data of the last frame
+
+        def encode(layer):
+            if cache is not None:
+                key = cache.key(layer.z, *params)
+                data = cache.get(key)
+                if data is not None:
+                    return data
+            frame = self.render_frame(layer, xsteps, ysteps, bbox, red)
+            digest = frame.digest()
+            if digest == last[0]:
+                data = last[1]
+            else:
+                data = frame.png() if png else frame.tostring()
+                last[:] = digest, data
+            if cache is not None:
+                cache.put(key, data)
+            return data
+
+        if processes == 1:
+            for layer in self.layers(z_start, z_step, count):
+                yield layer.z, encode(layer)
+            return
+
+        def render(z):
+            return z, encode(Layer(z, self.mesh.layer(z)))
+
+        zs = [z_start + i * z_step for i in range(count)]
+        for result in ordered_map(render, zs, processes, lookahead):
+            yield result
+
+    def contours(self, z, cache=None):
+        """
+        The outline of the layer at height z, see mesh.Layer.contours,
+        kept in cache if one is given.
+
+        >>> import shutil, tempfile
+        >>> A = Vector(0, 0, 0)
+        >>> B = Vector(1, 0, 0)
+        >>> C = Vector(0, 1, 0)
+        >>> D = Vector(0, 0, 1)
+        >>> stl = Stl(Triangle(A, B, D),
+        ...           Triangle(A, C, B),
+        ...           Triangle(A, D, C),
+        ...           Triangle(B, C, D))
+        >>> cache = SliceCache(tempfile.mkdtemp())
+        >>> stl.contours(0.5, cache) == stl.contours(0.5, cache) == \\
+        ...     stl.contours(0.5)
+        True
+        >>> len(list(cache.entries()))
+        1
+        >>> shutil.rmtree(cache.directory)
+        """
+        if cache is not None:
+            key = cache.key(z, self.digest(), 'contours')
+            data = cache.get(key)
+            if data is not None:
+                return decode_contours(data)
+        contours = Layer(z, self.mesh.layer(z)).contours()
+        if cache is not None:
+            cache.put(key, encode_contours(contours))
+        return contours
+
+    def render(self, layer, xsteps, ysteps, bbox, red):
+        return self.render_frame(layer, xsteps, ysteps, bbox, red).tostring()
+
+    def render_frame(self, layer, xsteps, ysteps, bbox, red):
+        """
+        Rasterize a layer into an xsteps by ysteps Frame covering bbox.
+        The crossings of every row are found in one batch, see
+        Layer.spans, and the spans of solid are located in the row of
+        pixel x coordinates by binary search and painted into the Frame
+        all at once.
+        """
+        xs = numpy.array(list(bbox.getXiterator(xsteps)))
+        rows, x1s, x2s = layer.spans(list(bbox.getYiterator(ysteps)))
+        frame = Frame(xsteps, ysteps)
+        frame.spans(rows, numpy.searchsorted(xs, x1s, side='left'),
+                    numpy.searchsorted(xs, x2s, side='right'),
+                    RED if red else WHITE)
+        return frame
+
+
+def frame_bbox(bbox, width, height, scale=None):
+    """
+    The region a width by height frame shows, centered on bbox. By
+    default bbox is widened in x or y to the frame's aspect ratio, so the
+    whole part fits. With scale, pixels are 1/scale units apart.
+
+    >>> bbox = BBox(Vector(0, 0, 0), Vector(4, 4, 1))
+    >>> frame_bbox(bbox, 8, 4)
+    <BBox <-2.0,0.0,0.0> <6.0,4.0,1.0>>
+    >>> frame_bbox(bbox, 9, 5, scale=4)
+    <BBox <1.0,1.5,0> <3.0,2.5,1>>
+    """
+    if scale is not None:
+        half = Vector((width - 1) / 2.0 / scale, (height - 1) / 2.0 / scale,
+                      0)
+        center = bbox._min.add(bbox._max).scale(0.5)
+        return BBox(Vector(center.x - half.x, center.y - half.y,
+                           bbox._min.z),
+                    Vector(center.x + half.x, center.y + half.y,
+                           bbox._max.z))
+    bbox = bbox.copy()
     sz = bbox.size()
     desired_aspect_ratio = 1. * height / width
     stl_aspect_ratio = 1. * sz.y / sz.x
@@ -166,11 +570,62 @@ def generateRgb(z, filename, red, width=1024, height=768):
     else:
         sz.x = (stl_aspect_ratio / desired_aspect_ratio) * sz.y
     bbox.set_size(sz)
-    # TODO scale the STL
+    return bbox
+
+
+def place(filename, width=1024, height=768, scale=None, mmap=False,
+          rotate=None, fit=False):
+    """
+    Read an STL and put the part where it is to be sliced: turned by
+    rotate, degrees about the x, y then z axis, and then with fit, placed
+    on the build area at scale pixels per unit (see Stl.fit). Returns the
+    Stl and the region a width by height frame shows, see frame_bbox.
+    """
+    stl = Stl(filename, mmap=mmap)
+    if rotate:
+        ax, ay, az = rotate
+        stl.transform(numpy.dot(rotation('z', az),
+                                numpy.dot(rotation('y', ay),
+                                          rotation('x', ax))))
+    if fit:
+        stl.fit(width, height, scale)
+    return stl, frame_bbox(stl._bbox, width, height, scale)
+
+
+def generateRgb(z, filename, red, width=1024, height=768, mmap=False,
+                scale=None, rotate=None, fit=False):
+    stl, bbox = place(filename, width, height, scale, mmap, rotate, fit)
     str = stl.make_layer(z, width, height, bbox, red)
     sys.stdout.write(str)
 
 
+def slice_layers(filename, out, z_start, z_step, count, red, width=1024,
+                 height=768, scale=None, raw=False, processes=1, mmap=False,
+                 cache=None, rotate=None, fit=False):
+    """
+    Slice count layers from z_start up, z_step apart, loading the STL
+    once, and write them to the directory out as layer-0000.png and so
+    on, or as raw RGB layer-0000.rgb files.
+    """
+    stl, bbox = place(filename, width, height, scale, mmap, rotate, fit)
+    if not os.path.isdir(out):
+        os.makedirs(out)
+    layers = stl.make_layers(z_start, z_step, count, width, height, bbox, red,
+                             processes=processes, png=not raw, cache=cache)
+    for i, (z, data) in enumerate(layers):
+        name = 'layer-{0:04d}.{1}'.format(i, 'rgb' if raw else 'png')
+        atomic_write(os.path.join(out, name), data)
+
+
+def parse_angles(text):
+    """
+    >>> parse_angles('90,0,-45')
+    (90.0, 0.0, -45.0)
+    """
+    ax, ay, az = [string.atof(a) for a in text.split(',')]
+    return ax, ay, az
+
+
 def main():
     args = docopt.docopt(__doc__.replace('CMD', sys.argv[0]))
 
@@ -181,17 +636,41 @@ def main():
                                            optionflags=doctest.ELLIPSIS)
         sys.exit(failure_count)
 
+    filename = args['<filename>']
+    mmap = args['-m'] or args['--mmap']
+    red = args['--red']
+    width = string.atoi(args['--width'])
+    height = string.atoi(args['--height'])
+    scale = args['--scale'] and string.atof(args['--scale'])
+    rotate = args['--rotate'] and parse_angles(args['--rotate'])
+    fit = args['--fit']
+    if fit and not scale:
+        sys.exit('--fit needs --scale')
+
+    if args['slice']:
+        cache = None
+        if args['--cache']:
+            cache = SliceCache(args['--cache'],
+                               string.atoi(args['--cache-size']) << 20)
+        slice_layers(filename, args['--out'], string.atof(args['--z-start']),
+                     string.atof(args['--z-step']),
+                     string.atoi(args['--count']), red, width, height, scale,
+                     raw=args['--raw'],
+                     processes=string.atoi(args['-j']) or None, mmap=mmap,
+                     cache=cache, rotate=rotate, fit=fit)
+
     else:
         assert args['-f'] and args['-z']
-        z = string.atof(args['-z'])
-        filename = args['<filename>']
+        z = string.atof(args['<ZVALUE>'])
         profile = args['-p'] or args['--profile']
         if profile:
             import cProfile
-            cProfile.run('generateRgb({0},"{1}",False)'.format(z, filename))
+            cProfile.run('generateRgb({0},"{1}",{2},{3},{4},{5},{6},{7},{8})'
+                         .format(z, filename, red, width, height, mmap,
+                                 scale, rotate, fit))
         else:
-            # TODO enable red, width and height as command line args
-            generateRgb(z, filename, False)
+            generateRgb(z, filename, red, width, height, mmap, scale, rotate,
+                        fit)
 
 
 if __name__ == '__main__':